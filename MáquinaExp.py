@@ -1,15 +1,76 @@
+import asyncio
+import csv
+import io
+import hashlib
+import json
+import math
 import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from itertools import chain
 from typing import List
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
 import fastapi.middleware.cors
-app = FastAPI()
+
+# orjson es opcional: si está instalado se usa para serializar las respuestas JSON
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# NumPy es opcional: sin él, el pronóstico de agotamiento responde 503
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class RespuestaJSON(JSONResponse):
+    """JSONResponse que serializa con orjson cuando está disponible."""
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+
+def _linea_json(valor) -> str:
+    """Una línea NDJSON (sin el salto de línea)."""
+    if orjson is not None:
+        return orjson.dumps(valor).decode()
+    return json.dumps(valor, ensure_ascii=False)
+
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    # Preparar el esquema una sola vez al arrancar, no al importar el módulo
+    db.migrar()
+    await catalogo_productos.vigente(db)
+    await claves_idempotencia.cargar(db)
+    db.iniciar_reportes()
+    claves_idempotencia.iniciar_purga(db)
+    yield
+    # Confirmar las escrituras encoladas, detener las instantáneas, esperar las consultas en curso y cerrar el pool
+    await claves_idempotencia.detener()
+    await db.detener()
+    db.cerrar()
+
+
+app = FastAPI(lifespan=ciclo_de_vida, default_response_class=RespuestaJSON)
 
 # Origen permitido
 origins = [
@@ -32,26 +93,44 @@ def obtener_directorio_actual():
     return os.path.dirname(os.path.realpath(__file__))
 
 
-try:
-    directorio_actual = obtener_directorio_actual()
-    ruta_db = os.path.join(directorio_actual, "registro.db")
+directorio_actual = obtener_directorio_actual()
+ruta_db = os.environ.get("MAQUINAS_DB", os.path.join(directorio_actual, "registro.db"))
 
-    conexion = sqlite3.connect(ruta_db)
-    cursor = conexion.cursor()
 
-    cursor.execute('''CREATE TABLE IF NOT EXISTS maquinas (
-                        serial INTEGER PRIMARY KEY,
-                        ubicacion TEXT,
-                        direccion TEXT,  -- Nuevo campo para la dirección
-                        estado TEXT DEFAULT 'apagada'
-                      )''')
+# Migraciones del esquema: MIGRACIONES[i] lleva la base de la versión i a la i + 1.
+# La versión aplicada se guarda en PRAGMA user_version.
+PRODUCTOS_INICIALES = [("Soles", 15.5), ("Gansito", 19.5), ("Donas Bimbo", 15.0)]
 
+
+def _migracion_1(cursor: sqlite3.Cursor):
+    """Esquema inicial, índices, resúmenes de ventas y productos de ejemplo."""
+    _migracion_1_maquinas(cursor)
+    _migracion_1_productos(cursor)
+
+
+def _migracion_1_productos(cursor: sqlite3.Cursor):
+    """Catálogo de productos con los productos de ejemplo."""
     cursor.execute('''CREATE TABLE IF NOT EXISTS productos (
                         num_serie INTEGER PRIMARY KEY,
                         nombre TEXT,
                         precio REAL
                       )''')
 
+    # Solo se insertan los productos de ejemplo que aún no existan
+    for nombre, precio in PRODUCTOS_INICIALES:
+        cursor.execute("INSERT INTO productos (nombre, precio) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM productos WHERE nombre = ?)",
+                       (nombre, precio, nombre))
+
+
+def _migracion_1_maquinas(cursor: sqlite3.Cursor):
+    """Máquinas, slots, ventas, resurtidos, incidencias, solicitudes de relleno y resúmenes de ventas."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS maquinas (
+                        serial INTEGER PRIMARY KEY,
+                        ubicacion TEXT,
+                        direccion TEXT,  -- Nuevo campo para la dirección
+                        estado TEXT DEFAULT 'apagada'
+                      )''')
+
     cursor.execute('''CREATE TABLE IF NOT EXISTS ventas (
                         id INTEGER PRIMARY KEY,
                         serie_maquina INTEGER,
@@ -101,17 +180,1338 @@ try:
                     FOREIGN KEY (serial_maquina) REFERENCES maquinas (serial)
                   )''')
 
+    # Índices para las búsquedas por máquina
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ventas_maquina ON ventas (serie_maquina, monto)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_incidencias_maquina ON incidencias (serie_maquina)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_slots_maquina ON slots (serial_maquina, num_slot)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_solicitudes_relleno_maquina ON solicitudes_relleno (num_serie_maquina)")
+    # Conjunto de existencias bajas: SQLite lo mantiene al vender y resurtir
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_resurtidos_cantidad ON resurtidos (cantidad)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_slots_capacidad ON slots (capacidad_maxima)")
+
+    # Un solo registro por máquina, producto y slot en resurtidos
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='uq_resurtidos_slot'")
+    if cursor.fetchone() is None:
+        # Fusionar los registros duplicados que pudieran existir antes de crear la restricción
+        cursor.execute('''UPDATE resurtidos SET cantidad = (
+                            SELECT SUM(r.cantidad) FROM resurtidos r
+                            WHERE r.serie_maquina IS resurtidos.serie_maquina
+                              AND r.num_serie IS resurtidos.num_serie
+                              AND r.num_slot IS resurtidos.num_slot)
+                          WHERE id IN (SELECT MIN(id) FROM resurtidos
+                                       GROUP BY serie_maquina, num_serie, num_slot HAVING COUNT(*) > 1)''')
+        cursor.execute('''DELETE FROM resurtidos WHERE id NOT IN (
+                            SELECT MIN(id) FROM resurtidos GROUP BY serie_maquina, num_serie, num_slot)''')
+        cursor.execute("CREATE UNIQUE INDEX uq_resurtidos_slot ON resurtidos (serie_maquina, num_serie, num_slot)")
+
+    # Resúmenes de ingresos por máquina, por mes y por día, mantenidos por disparadores al registrar ventas
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='ventas_por_maquina'")
+    resumenes_existentes = cursor.fetchone() is not None
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ventas_por_maquina (
+                        serie_maquina INTEGER PRIMARY KEY,
+                        total REAL NOT NULL DEFAULT 0,
+                        num_ventas INTEGER NOT NULL DEFAULT 0
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ventas_por_mes (
+                        serie_maquina INTEGER,
+                        mes TEXT,  -- AAAA-MM
+                        total REAL NOT NULL DEFAULT 0,
+                        num_ventas INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (serie_maquina, mes)
+                      ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ventas_por_dia (
+                        serie_maquina INTEGER,
+                        dia TEXT,  -- AAAA-MM-DD
+                        total REAL NOT NULL DEFAULT 0,
+                        num_ventas INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (serie_maquina, dia)
+                      ) WITHOUT ROWID''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ventas_por_maquina_total ON ventas_por_maquina (total)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ventas_por_mes_total ON ventas_por_mes (mes, total)")
+
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_ventas_resumen_insertar AFTER INSERT ON ventas
+                      BEGIN
+                        INSERT INTO ventas_por_maquina (serie_maquina, total, num_ventas) VALUES (NEW.serie_maquina, NEW.monto, 1)
+                          ON CONFLICT (serie_maquina) DO UPDATE SET total = total + excluded.total, num_ventas = num_ventas + 1;
+                        INSERT INTO ventas_por_mes (serie_maquina, mes, total, num_ventas) VALUES (NEW.serie_maquina, substr(NEW.fecha, 1, 7), NEW.monto, 1)
+                          ON CONFLICT (serie_maquina, mes) DO UPDATE SET total = total + excluded.total, num_ventas = num_ventas + 1;
+                        INSERT INTO ventas_por_dia (serie_maquina, dia, total, num_ventas) VALUES (NEW.serie_maquina, substr(NEW.fecha, 1, 10), NEW.monto, 1)
+                          ON CONFLICT (serie_maquina, dia) DO UPDATE SET total = total + excluded.total, num_ventas = num_ventas + 1;
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS trg_ventas_resumen_eliminar AFTER DELETE ON ventas
+                      BEGIN
+                        UPDATE ventas_por_maquina SET total = total - OLD.monto, num_ventas = num_ventas - 1
+                          WHERE serie_maquina = OLD.serie_maquina;
+                        UPDATE ventas_por_mes SET total = total - OLD.monto, num_ventas = num_ventas - 1
+                          WHERE serie_maquina = OLD.serie_maquina AND mes = substr(OLD.fecha, 1, 7);
+                        UPDATE ventas_por_dia SET total = total - OLD.monto, num_ventas = num_ventas - 1
+                          WHERE serie_maquina = OLD.serie_maquina AND dia = substr(OLD.fecha, 1, 10);
+                      END''')
+
+    if not resumenes_existentes:
+        # Calcular los resúmenes a partir del historial de ventas ya registrado
+        cursor.execute("INSERT INTO ventas_por_maquina (serie_maquina, total, num_ventas) "
+                       "SELECT serie_maquina, SUM(monto), COUNT(*) FROM ventas GROUP BY serie_maquina")
+        cursor.execute("INSERT INTO ventas_por_mes (serie_maquina, mes, total, num_ventas) "
+                       "SELECT serie_maquina, substr(fecha, 1, 7), SUM(monto), COUNT(*) FROM ventas GROUP BY 1, 2")
+        cursor.execute("INSERT INTO ventas_por_dia (serie_maquina, dia, total, num_ventas) "
+                       "SELECT serie_maquina, substr(fecha, 1, 10), SUM(monto), COUNT(*) FROM ventas GROUP BY 1, 2")
+
+
+def _migracion_2(cursor: sqlite3.Cursor):
+    """Agrega la columna nombre_persona que usa el registro de incidencias."""
+    cursor.execute("PRAGMA table_info(incidencias)")
+    if "nombre_persona" not in {fila[1] for fila in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE incidencias ADD COLUMN nombre_persona TEXT")
+
+
+def _migracion_3(cursor: sqlite3.Cursor):
+    """Guarda ventas.fecha como época Unix entera e indexa los rangos de fechas."""
+    cursor.execute('''CREATE TABLE ventas_nueva (
+                        id INTEGER PRIMARY KEY,
+                        serie_maquina INTEGER,
+                        num_serie INTEGER,
+                        nombre_producto TEXT,
+                        monto REAL,
+                        cantidad INTEGER,
+                        fecha INTEGER,  -- Segundos desde la época Unix
+                        FOREIGN KEY (serie_maquina) REFERENCES maquinas (serial),
+                        FOREIGN KEY (num_serie) REFERENCES productos (num_serie)
+                      )''')
+    # Las fechas anteriores son texto en hora local, como las escribía str(datetime.now())
+    cursor.execute("INSERT INTO ventas_nueva (id, serie_maquina, num_serie, nombre_producto, monto, cantidad, fecha) "
+                   "SELECT id, serie_maquina, num_serie, nombre_producto, monto, cantidad, "
+                   "       CASE WHEN typeof(fecha) = 'integer' THEN fecha "
+                   "            ELSE CAST(strftime('%s', fecha, 'utc') AS INTEGER) END "
+                   "FROM ventas")
+    # Al eliminar la tabla anterior se eliminan también sus índices y disparadores
+    cursor.execute("DROP TABLE ventas")
+    cursor.execute("ALTER TABLE ventas_nueva RENAME TO ventas")
+
+    cursor.execute("CREATE INDEX idx_ventas_maquina_fecha ON ventas (serie_maquina, fecha)")
+    cursor.execute("CREATE INDEX idx_ventas_producto_fecha ON ventas (num_serie, fecha)")
+    cursor.execute("CREATE INDEX idx_ventas_fecha ON ventas (fecha)")
+
+    cursor.execute('''CREATE TRIGGER trg_ventas_resumen_insertar AFTER INSERT ON ventas
+                      BEGIN
+                        INSERT INTO ventas_por_maquina (serie_maquina, total, num_ventas) VALUES (NEW.serie_maquina, NEW.monto, 1)
+                          ON CONFLICT (serie_maquina) DO UPDATE SET total = total + excluded.total, num_ventas = num_ventas + 1;
+                        INSERT INTO ventas_por_mes (serie_maquina, mes, total, num_ventas)
+                          VALUES (NEW.serie_maquina, strftime('%Y-%m', NEW.fecha, 'unixepoch', 'localtime'), NEW.monto, 1)
+                          ON CONFLICT (serie_maquina, mes) DO UPDATE SET total = total + excluded.total, num_ventas = num_ventas + 1;
+                        INSERT INTO ventas_por_dia (serie_maquina, dia, total, num_ventas)
+                          VALUES (NEW.serie_maquina, strftime('%Y-%m-%d', NEW.fecha, 'unixepoch', 'localtime'), NEW.monto, 1)
+                          ON CONFLICT (serie_maquina, dia) DO UPDATE SET total = total + excluded.total, num_ventas = num_ventas + 1;
+                      END''')
+    cursor.execute('''CREATE TRIGGER trg_ventas_resumen_eliminar AFTER DELETE ON ventas
+                      BEGIN
+                        UPDATE ventas_por_maquina SET total = total - OLD.monto, num_ventas = num_ventas - 1
+                          WHERE serie_maquina = OLD.serie_maquina;
+                        UPDATE ventas_por_mes SET total = total - OLD.monto, num_ventas = num_ventas - 1
+                          WHERE serie_maquina = OLD.serie_maquina AND mes = strftime('%Y-%m', OLD.fecha, 'unixepoch', 'localtime');
+                        UPDATE ventas_por_dia SET total = total - OLD.monto, num_ventas = num_ventas - 1
+                          WHERE serie_maquina = OLD.serie_maquina AND dia = strftime('%Y-%m-%d', OLD.fecha, 'unixepoch', 'localtime');
+                      END''')
+
+
+def _migracion_4(cursor: sqlite3.Cursor):
+    """Contador de versión del catálogo de productos, incrementado por disparadores en cada cambio."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS catalogo_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL
+                      )''')
+    cursor.execute("INSERT OR IGNORE INTO catalogo_version (id, version) VALUES (1, 0)")
+    for evento in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_productos_version_{evento.lower()} AFTER {evento} ON productos
+                           BEGIN
+                             UPDATE catalogo_version SET version = version + 1 WHERE id = 1;
+                           END''')
+
+
+def _migracion_5(cursor: sqlite3.Cursor):
+    """Inventario vigente por (máquina, slot); resurtidos queda como bitácora de solo inserción."""
+    cursor.execute('''CREATE TABLE inventario (
+                        serie_maquina INTEGER NOT NULL,
+                        num_slot INTEGER NOT NULL,
+                        num_serie INTEGER NOT NULL,
+                        cantidad INTEGER NOT NULL CHECK (cantidad >= 0),
+                        ultimo_resurtido TEXT,
+                        PRIMARY KEY (serie_maquina, num_slot)
+                      ) WITHOUT ROWID''')
+    # Cada slot contiene un solo producto: de los registros anteriores se conserva el de más existencias
+    cursor.execute('''INSERT INTO inventario (serie_maquina, num_slot, num_serie, cantidad, ultimo_resurtido)
+                      SELECT serie_maquina, num_slot, num_serie, MAX(cantidad, 0), fecha FROM (
+                        SELECT *, ROW_NUMBER() OVER (PARTITION BY serie_maquina, num_slot ORDER BY cantidad DESC, id) AS orden
+                        FROM resurtidos
+                        WHERE serie_maquina IS NOT NULL AND num_slot IS NOT NULL AND num_serie IS NOT NULL)
+                      WHERE orden = 1''')
+    # Slot de menor número con existencias de un producto, y conjunto de existencias bajas para la flota
+    cursor.execute("CREATE INDEX idx_inventario_producto ON inventario (serie_maquina, num_serie, num_slot)")
+    cursor.execute("CREATE INDEX idx_inventario_cantidad ON inventario (cantidad)")
+
+    # La bitácora admite varios resurtidos del mismo producto en el mismo slot
+    cursor.execute("DROP INDEX IF EXISTS uq_resurtidos_slot")
+    cursor.execute("DROP INDEX IF EXISTS idx_resurtidos_cantidad")
+    cursor.execute("CREATE INDEX idx_resurtidos_maquina ON resurtidos (serie_maquina, fecha)")
+
+
+def _migracion_6(cursor: sqlite3.Cursor):
+    """Claves de idempotencia de ventas y resurtidos, con la respuesta que se dio a cada una."""
+    cursor.execute('''CREATE TABLE claves_idempotencia (
+                        ruta TEXT NOT NULL,
+                        serie_maquina INTEGER NOT NULL,
+                        clave TEXT NOT NULL,
+                        huella TEXT NOT NULL,  -- SHA-1 de los parámetros de la petición original
+                        respuesta TEXT NOT NULL,  -- JSON
+                        creada INTEGER NOT NULL,  -- Segundos desde la época Unix
+                        PRIMARY KEY (ruta, serie_maquina, clave)
+                      ) WITHOUT ROWID''')
+    cursor.execute("CREATE INDEX idx_claves_idempotencia_creada ON claves_idempotencia (creada)")
+
+
+def _migracion_7(cursor: sqlite3.Cursor):
+    """Índices para que los rangos de ventas y las páginas por máquina no ordenen en tablas temporales."""
+    # Rango de ventas de un producto en una máquina
+    cursor.execute("CREATE INDEX idx_ventas_maquina_producto_fecha ON ventas (serie_maquina, num_serie, fecha)")
+    # Páginas por id de una máquina: el índice de una sola columna guarda sus filas en orden de id
+    cursor.execute("CREATE INDEX idx_ventas_maquina ON ventas (serie_maquina)")
+    cursor.execute("DROP INDEX IF EXISTS idx_resurtidos_maquina")
+    cursor.execute("CREATE INDEX idx_resurtidos_maquina ON resurtidos (serie_maquina)")
+
+
+MIGRACIONES = [_migracion_1, _migracion_2, _migracion_3, _migracion_4, _migracion_5, _migracion_6, _migracion_7]
+# Con varios fragmentos, el archivo del catálogo solo lleva los productos y cada fragmento solo las tablas de máquinas
+MIGRACIONES_CATALOGO = [_migracion_1_productos, _migracion_4]
+MIGRACIONES_FRAGMENTO = [_migracion_1_maquinas, _migracion_2, _migracion_3, _migracion_5, _migracion_6, _migracion_7]
+
+
+def migrar_base_datos(ruta: str, migraciones: list = MIGRACIONES) -> int:
+    """Aplica las migraciones pendientes y devuelve la versión del esquema.
+
+    Si el esquema ya está al día solo se lee PRAGMA user_version.
+    """
+    conexion = sqlite3.connect(ruta)
+    try:
+        cursor = conexion.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(migraciones):
+            return version
+
+        # Otro proceso pudo migrar mientras tanto: volver a leer la versión con el bloqueo tomado
+        cursor.execute("BEGIN IMMEDIATE")
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for numero in range(version, len(migraciones)):
+            migraciones[numero](cursor)
+            cursor.execute(f"PRAGMA user_version = {numero + 1}")
+        conexion.commit()
+        return len(migraciones)
+    except sqlite3.Error as e:
+        conexion.rollback()
+        print("Error al migrar la base de datos:", e)
+        raise
+    finally:
+        conexion.close()
+
+
+# Métricas en formato de texto de Prometheus
+BUCKETS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metricas:
+    """Contadores e histogramas en memoria, seguros entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        self._ayuda = {}
+
+    def describir(self, nombre: str, tipo: str, ayuda: str):
+        self._ayuda[nombre] = (tipo, ayuda)
+
+    def incrementar(self, nombre: str, etiquetas: tuple = (), valor: float = 1):
+        clave = (nombre, etiquetas)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre: str, etiquetas: tuple, segundos: float):
+        clave = (nombre, etiquetas)
+        with self._lock:
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = [[0] * len(BUCKETS_SEGUNDOS), 0.0, 0]
+            for indice, limite in enumerate(BUCKETS_SEGUNDOS):
+                if segundos <= limite:
+                    histograma[0][indice] += 1
+                    break
+            histograma[1] += segundos
+            histograma[2] += 1
+
+    @staticmethod
+    def _etiquetas(etiquetas: tuple) -> str:
+        if not etiquetas:
+            return ""
+        partes = ['%s="%s"' % (nombre, str(valor).replace("\\", "\\\\").replace('"', '\\"')) for nombre, valor in etiquetas]
+        return "{" + ",".join(partes) + "}"
+
+    def exportar(self) -> str:
+        with self._lock:
+            contadores = dict(self._contadores)
+            histogramas = {clave: (list(valor[0]), valor[1], valor[2]) for clave, valor in self._histogramas.items()}
+
+        lineas, descritas = [], set()
+
+        def cabecera(nombre):
+            if nombre not in descritas and nombre in self._ayuda:
+                tipo, ayuda = self._ayuda[nombre]
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} {tipo}")
+                descritas.add(nombre)
+
+        for (nombre, etiquetas), valor in sorted(contadores.items()):
+            cabecera(nombre)
+            lineas.append(f"{nombre}{self._etiquetas(etiquetas)} {valor}")
+        for (nombre, etiquetas), (buckets, suma, cuenta) in sorted(histogramas.items()):
+            cabecera(nombre)
+            acumulado = 0
+            for limite, cantidad in zip(BUCKETS_SEGUNDOS, buckets):
+                acumulado += cantidad
+                lineas.append(f"{nombre}_bucket{self._etiquetas(etiquetas + (('le', limite),))} {acumulado}")
+            lineas.append(f"{nombre}_bucket{self._etiquetas(etiquetas + (('le', '+Inf'),))} {cuenta}")
+            lineas.append(f"{nombre}_sum{self._etiquetas(etiquetas)} {suma}")
+            lineas.append(f"{nombre}_count{self._etiquetas(etiquetas)} {cuenta}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = Metricas()
+metricas.describir("maquinas_http_peticiones_total", "counter", "Peticiones atendidas por ruta, método y código")
+metricas.describir("maquinas_http_errores_total", "counter", "Peticiones que terminaron con error 5xx o excepción")
+metricas.describir("maquinas_http_duracion_segundos", "histogram", "Latencia de las peticiones por ruta")
+metricas.describir("maquinas_sql_duracion_segundos", "histogram", "Tiempo de ejecución de cada sentencia SQL")
+metricas.describir("maquinas_sql_filas_total", "counter", "Filas devueltas por cada sentencia SQL")
+metricas.describir("maquinas_sql_bloqueos_total", "counter", "Sentencias que fallaron por base bloqueada (SQLITE_BUSY), tras busy_timeout")
+metricas.describir("maquinas_sql_errores_total", "counter", "Sentencias SQL que terminaron en error")
+metricas.describir("maquinas_ws_eventos_total", "counter", "Eventos de telemetría recibidos por WebSocket, por tipo y código")
+metricas.describir("maquinas_ws_lote_duracion_segundos", "histogram", "Tiempo en aplicar y confirmar cada lote de telemetría")
+metricas.describir("maquinas_sse_descartados_total", "counter", "Suscriptores de /eventos/ descartados por no leer a tiempo")
+metricas.describir("maquinas_idempotencia_repetidas_total", "counter",
+                   "Reintentos con clave de idempotencia ya vista, por ruta y por dónde se resolvieron")
+
+
+@lru_cache(maxsize=1024)
+def _etiqueta_sentencia(sql: str) -> str:
+    # Colapsar espacios y listas IN de longitud variable para acotar el número de series
+    sql = re.sub(r"\s+", " ", sql).strip()
+    sql = re.sub(r"\(\?(?:\s*,\s*\?)+\)", "(?...)", sql)
+    return sql[:160]
+
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """Cursor que mide cada sentencia, cuenta las filas leídas y los errores por base bloqueada."""
+
+    def _medir(self, metodo, sql, parametros):
+        etiqueta = (("sentencia", _etiqueta_sentencia(sql)),)
+        self._etiqueta = etiqueta
+        inicio = time.perf_counter()
+        try:
+            resultado = metodo(self, sql, parametros)
+        except sqlite3.Error as e:
+            # La espera ante una base bloqueada es la de busy_timeout; aquí solo se cuenta
+            if isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e)):
+                metricas.incrementar("maquinas_sql_bloqueos_total", etiqueta)
+            metricas.incrementar("maquinas_sql_errores_total", etiqueta)
+            raise
+        metricas.observar("maquinas_sql_duracion_segundos", etiqueta, time.perf_counter() - inicio)
+        return resultado
+
+    def execute(self, sql, parametros=()):
+        return self._medir(sqlite3.Cursor.execute, sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self._medir(sqlite3.Cursor.executemany, sql, parametros)
+
+    def _contar(self, filas):
+        etiqueta = getattr(self, "_etiqueta", None)
+        if etiqueta is not None and filas:
+            metricas.incrementar("maquinas_sql_filas_total", etiqueta, filas)
+
+    def fetchone(self):
+        fila = super().fetchone()
+        self._contar(fila is not None)
+        return fila
+
+    def fetchmany(self, *args, **kwargs):
+        filas = super().fetchmany(*args, **kwargs)
+        self._contar(len(filas))
+        return filas
+
+    def fetchall(self):
+        filas = super().fetchall()
+        self._contar(len(filas))
+        return filas
+
+
+class ConexionInstrumentada(sqlite3.Connection):
+    """Conexión cuyos cursores (incluidos los de Connection.execute) están instrumentados."""
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor().executemany(sql, parametros)
+
+
+class MiddlewareMetricas:
+    """Middleware ASGI que registra cuenta, latencia y errores por plantilla de ruta."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        codigo = 500
+        inicio = time.perf_counter()
+
+        async def enviar(mensaje):
+            nonlocal codigo
+            if mensaje["type"] == "http.response.start":
+                codigo = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            ruta = getattr(scope.get("route"), "path", "sin_ruta")
+            etiquetas = (("metodo", scope["method"]), ("ruta", ruta))
+            metricas.observar("maquinas_http_duracion_segundos", etiquetas, time.perf_counter() - inicio)
+            metricas.incrementar("maquinas_http_peticiones_total", etiquetas + (("codigo", codigo),))
+            if codigo >= 500:
+                metricas.incrementar("maquinas_http_errores_total", etiquetas)
+
+
+app.add_middleware(MiddlewareMetricas)
+
+
+@app.get("/metrics")
+async def exportar_metricas():
+    return PlainTextResponse(metricas.exportar(), media_type="text/plain; version=0.0.4")
+
+
+# Configuración del pool de conexiones
+TAMANO_POOL = int(os.environ.get("MAQUINAS_POOL_SIZE", "8"))
+PRAGMAS_CONEXION = {
+    "journal_mode": "WAL",       # Los lectores no bloquean al escritor
+    "synchronous": os.environ.get("MAQUINAS_SYNCHRONOUS", "NORMAL"),  # FULL: fsync en cada confirmación
+    "busy_timeout": 5000,        # Milisegundos de espera si la base está bloqueada
+    "cache_size": -16000,        # ~16 MB de caché de páginas por conexión
+    "mmap_size": 268435456,      # 256 MB mapeados en memoria
+}
+
+
+class PoolConexiones:
+    """Pool de conexiones SQLite de larga duración, reutilizadas entre peticiones."""
+
+    def __init__(self, ruta: str, tamano: int = TAMANO_POOL, pragmas: Optional[dict] = None, timeout: float = 30.0,
+                 catalogo: Optional[str] = None, fragmento: tuple = (0, 1), solo_lectura: bool = False):
+        self.ruta = ruta
+        self.tamano = tamano
+        self.pragmas = dict(PRAGMAS_CONEXION if pragmas is None else pragmas)
+        self.timeout = timeout
+        self.catalogo = catalogo
+        self.fragmento = fragmento
+        self.solo_lectura = solo_lectura
+        self._libres = queue.LifoQueue()
+        self._creadas = 0
+        self._lock = threading.Lock()
+
+    def _crear_conexion(self) -> sqlite3.Connection:
+        conexion = sqlite3.connect(self.ruta, check_same_thread=False, factory=ConexionInstrumentada)
+        for nombre, valor in self.pragmas.items():
+            conexion.execute(f"PRAGMA {nombre}={valor}")
+        if self.catalogo is not None:
+            # En un fragmento, "productos" es el catálogo compartido; el fragmento no tiene tabla propia
+            conexion.execute("ATTACH DATABASE ? AS catalogo", (self.catalogo,))
+            conexion.execute("CREATE TEMP VIEW productos AS SELECT * FROM catalogo.productos")
+        if self.solo_lectura:
+            # Después de crear la vista temporal, que también cuenta como escritura
+            conexion.execute("PRAGMA query_only=1")
+        conexion.fragmento = self.fragmento
+        return conexion
+
+    def adquirir(self) -> sqlite3.Connection:
+        try:
+            return self._libres.get_nowait()
+        except queue.Empty:
+            pass
+
+        # Crear una conexión nueva solo si no se ha alcanzado el tamaño del pool
+        with self._lock:
+            crear = self._creadas < self.tamano
+            if crear:
+                self._creadas += 1
+        if crear:
+            try:
+                return self._crear_conexion()
+            except sqlite3.Error:
+                with self._lock:
+                    self._creadas -= 1
+                raise
+
+        try:
+            return self._libres.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("No hay conexiones disponibles en el pool")
+
+    def liberar(self, conexion: sqlite3.Connection):
+        try:
+            # Nunca devolver al pool una conexión con una transacción abierta
+            if conexion.in_transaction:
+                conexion.rollback()
+        except sqlite3.Error:
+            conexion.close()
+            with self._lock:
+                self._creadas -= 1
+            return
+        self._libres.put(conexion)
+
+    @contextmanager
+    def conexion(self):
+        conexion = self.adquirir()
+        try:
+            yield conexion
+        finally:
+            self.liberar(conexion)
+
+    def cerrar(self):
+        while True:
+            try:
+                conexion = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            conexion.close()
+            with self._lock:
+                self._creadas -= 1
+
+
+class BaseDatos:
+    """Ejecuta las consultas en un ejecutor dedicado para no bloquear el bucle de eventos.
+
+    El ejecutor tiene tantos hilos como conexiones el pool, de modo que la
+    concurrencia contra SQLite queda acotada y ningún hilo espera por una conexión.
+    Se crea al primer uso y cerrar() lo descarta, así la aplicación puede volver a arrancar
+    en el mismo proceso.
+    """
+
+    def __init__(self, pool: PoolConexiones, max_concurrencia: Optional[int] = None):
+        self.pool = pool
+        self.max_concurrencia = max_concurrencia or pool.tamano
+        self._ejecutor = None
+        self._lock = threading.Lock()
+        self.escritor = EscritorAgrupado(self) if ESCRITURA_AGRUPADA else None
+
+    @property
+    def ejecutor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._ejecutor is None:
+                self._ejecutor = ThreadPoolExecutor(max_workers=self.max_concurrencia, thread_name_prefix="sqlite")
+            return self._ejecutor
+
+    def _ejecutar(self, funcion, args):
+        with self.pool.conexion() as conexion:
+            return funcion(conexion, *args)
+
+    async def ejecutar(self, funcion, *args):
+        """Ejecuta funcion(conexion, *args) en el ejecutor con una conexión del pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.ejecutor, self._ejecutar, funcion, args)
+
+    async def escribir(self, funcion, *args):
+        """Ejecuta una escritura que no confirma por sí misma y confirma su transacción.
+
+        Con la escritura agrupada activada la operación se encola y se confirma junto
+        con otras; en ambos casos se devuelve el resultado ya confirmado.
+        """
+        if self.escritor is not None:
+            return await self.escritor.encolar(funcion, args)
+        return await self.ejecutar(_confirmar, funcion, args)
+
+    async def escribir_lote(self, operaciones: list) -> list:
+        """Confirma varias escrituras (funcion, args) juntas y devuelve (correcto, resultado o excepción) de cada una.
+
+        Sin escritura agrupada van en una sola transacción; con ella se encolan a la vez y
+        el escritor las confirma en el mismo lote que las demás operaciones pendientes.
+        """
+        if self.escritor is not None:
+            resultados = await asyncio.gather(*(self.escritor.encolar(funcion, args) for funcion, args in operaciones),
+                                              return_exceptions=True)
+            return [(not isinstance(resultado, BaseException), resultado) for resultado in resultados]
+        return await self.ejecutar(_aplicar_lote_escrituras, operaciones)
+
+    async def detener(self):
+        if self.escritor is not None:
+            await self.escritor.detener()
+
+    def cerrar(self):
+        with self._lock:
+            ejecutor, self._ejecutor = self._ejecutor, None
+        if ejecutor is not None:
+            ejecutor.shutdown(wait=True)
+        self.pool.cerrar()
+
+
+def _confirmar(conexion: sqlite3.Connection, funcion, args):
+    resultado = funcion(conexion, *args)
+    try:
+        conexion.commit()
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return resultado
+
+
+def _tomar_bloqueo_escritura(conexion: sqlite3.Connection):
+    """Abre la transacción con el bloqueo de escritura si la operación lee antes de escribir.
 
-    cursor.execute("INSERT INTO productos (nombre, precio) VALUES (?, ?)", ("Soles", 15.5))
-    cursor.execute("INSERT INTO productos (nombre, precio) VALUES (?, ?)", ("Gansito", 19.5))
-    cursor.execute("INSERT INTO productos (nombre, precio) VALUES (?, ?)", ("Donas Bimbo", 15.0))
+    _confirmar no abre la transacción: sin esto, la lectura se haría fuera de ella y otra
+    conexión podría escribir entre la lectura y la escritura. Dentro de un lote no hace nada.
+    """
+    if not conexion.in_transaction:
+        conexion.execute("BEGIN IMMEDIATE")
 
+
+def _aplicar_lote_escrituras(conexion: sqlite3.Connection, operaciones: list):
+    """Aplica varias escrituras en una transacción; cada una en su SAVEPOINT para aislar sus errores."""
+    cursor = conexion.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    resultados = []
+    for funcion, args in operaciones:
+        cursor.execute("SAVEPOINT operacion")
+        try:
+            resultados.append((True, funcion(conexion, *args)))
+        except Exception as e:
+            cursor.execute("ROLLBACK TO operacion")
+            resultados.append((False, e))
+        cursor.execute("RELEASE operacion")
     conexion.commit()
+    return resultados
+
+
+# Escritura agrupada (group commit) para ventas y resurtidos
+ESCRITURA_AGRUPADA = os.environ.get("MAQUINAS_GROUP_COMMIT", "0") == "1"
+ESCRITURA_AGRUPADA_MS = float(os.environ.get("MAQUINAS_GROUP_COMMIT_MS", "5"))
+ESCRITURA_AGRUPADA_MAX = int(os.environ.get("MAQUINAS_GROUP_COMMIT_MAX", "256"))
+
+
+class EscritorAgrupado:
+    """Una única tarea escritora que confirma las operaciones encoladas por lotes.
+
+    Un lote se cierra al juntar `max_operaciones` o al pasar `max_espera_ms` desde la
+    primera operación, lo que acota la latencia añadida. Cada llamador espera a que su
+    lote se confirme, así que la respuesta al cliente sigue siendo síncrona.
+    """
+
+    def __init__(self, base: BaseDatos, max_operaciones: int = ESCRITURA_AGRUPADA_MAX,
+                 max_espera_ms: float = ESCRITURA_AGRUPADA_MS):
+        self.base = base
+        self.max_operaciones = max_operaciones
+        self.max_espera = max_espera_ms / 1000
+        self._cola = None
+        self._tarea = None
+
+    async def encolar(self, funcion, args):
+        if self._tarea is None:
+            self._cola = asyncio.Queue()
+            self._tarea = asyncio.create_task(self._bucle())
+        futuro = asyncio.get_running_loop().create_future()
+        self._cola.put_nowait((funcion, args, futuro))
+        return await futuro
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._cola.put_nowait(None)
+            await self._tarea
+            self._tarea = None
+
+    async def _bucle(self):
+        loop = asyncio.get_running_loop()
+        terminar = False
+        while not terminar:
+            primera = await self._cola.get()
+            if primera is None:
+                return
+            lote = [primera]
+            limite = loop.time() + self.max_espera
+            while len(lote) < self.max_operaciones:
+                try:
+                    siguiente = self._cola.get_nowait()
+                except asyncio.QueueEmpty:
+                    restante = limite - loop.time()
+                    if restante <= 0:
+                        break
+                    try:
+                        siguiente = await asyncio.wait_for(self._cola.get(), restante)
+                    except asyncio.TimeoutError:
+                        break
+                if siguiente is None:
+                    terminar = True
+                    break
+                lote.append(siguiente)
+
+            try:
+                resultados = await self.base.ejecutar(_aplicar_lote_escrituras,
+                                                      [(funcion, args) for funcion, args, _ in lote])
+            except Exception as e:
+                error = HTTPException(status_code=500, detail=str(e)) if isinstance(e, sqlite3.Error) else e
+                resultados = [(False, error)] * len(lote)
+
+            for (_, _, futuro), (correcto, valor) in zip(lote, resultados):
+                if futuro.done():
+                    continue
+                if correcto:
+                    futuro.set_result(valor)
+                else:
+                    futuro.set_exception(valor)
+
+
+# Instantáneas de solo lectura para los reportes; 0 segundos las desactiva
+INTERVALO_REPORTES = float(os.environ.get("MAQUINAS_REPORTES_SEGUNDOS", "0"))
+ANTIGUEDAD_MAXIMA_REPORTES = float(os.environ.get("MAQUINAS_REPORTES_MAX_ANTIGUEDAD", str(2 * INTERVALO_REPORTES)))
+
+
+def _copiar_base(conexion: sqlite3.Connection, ruta: str):
+    """Copia la base principal de `conexion` a `ruta` con la API de respaldo en línea de SQLite."""
+    destino = sqlite3.connect(ruta)
+    try:
+        conexion.backup(destino)
+    finally:
+        destino.close()
+
+
+class InstantaneaReportes:
+    """Copia periódica de un archivo de la base para que los reportes no compitan con las ventas.
+
+    La copia se hace con una conexión del pool de origen (en WAL no bloquea a los escritores)
+    y las consultas de reportes usan su propio pool, de solo lectura, sobre <ruta>_reportes.db.
+    """
+
+    def __init__(self, origen: BaseDatos, intervalo: float = INTERVALO_REPORTES):
+        base, extension = os.path.splitext(origen.pool.ruta)
+        self.ruta = f"{base}_reportes{extension}"
+        self.origen = origen
+        self.intervalo = intervalo
+        self.base = BaseDatos(PoolConexiones(self.ruta, catalogo=origen.pool.catalogo,
+                                             fragmento=origen.pool.fragmento, solo_lectura=True))
+        self.generada = None
+        self._tarea = None
+
+    @property
+    def antiguedad(self) -> float:
+        """Segundos desde la última copia completa; infinito si aún no hay ninguna."""
+        return float("inf") if self.generada is None else time.monotonic() - self.generada
+
+    async def actualizar(self):
+        inicio = time.monotonic()
+        await self.origen.ejecutar(_copiar_base, self.ruta)
+        self.generada = inicio
+
+    def iniciar(self):
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def _bucle(self):
+        while True:
+            try:
+                await self.actualizar()
+            except sqlite3.Error as e:
+                # Si la copia falla, los reportes pasan a leer en vivo al superar la antigüedad máxima
+                print("Error al actualizar la instantánea de reportes:", e)
+            await asyncio.sleep(self.intervalo)
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        await self.base.detener()
+
+    def cerrar(self):
+        self.base.cerrar()
+
+
+# Fragmentación por serial de máquina
+NUM_FRAGMENTOS = int(os.environ.get("MAQUINAS_SHARDS", "1"))
+
+
+class ConjuntoFragmentos:
+    """Enrutado por serial de máquina sobre una lista de bases, una por fragmento."""
+
+    def __init__(self, fragmentos: list):
+        self.fragmentos = fragmentos
+
+    def para_maquina(self, serial: int) -> BaseDatos:
+        return self.fragmentos[serial % len(self.fragmentos)]
+
+    async def en_todos(self, funcion, *args) -> list:
+        """Ejecuta la misma consulta en todos los fragmentos y devuelve la lista de resultados."""
+        return await asyncio.gather(*(fragmento.ejecutar(funcion, *args) for fragmento in self.fragmentos))
+
+    async def por_fragmento(self, funcion, elementos: list, serial_de, con_indices: bool = False):
+        """Reparte `elementos` por fragmento según `serial_de(elemento)` y ejecuta `funcion` en cada uno.
+
+        Con `con_indices` devuelve también, por fragmento, las posiciones originales de sus elementos.
+        """
+        grupos = {}
+        for indice, elemento in enumerate(elementos):
+            grupos.setdefault(serial_de(elemento) % len(self.fragmentos), []).append(indice)
+        resultados = await asyncio.gather(*(self.fragmentos[fragmento].ejecutar(funcion, [elementos[i] for i in indices])
+                                            for fragmento, indices in grupos.items()))
+        return (list(grupos.values()), resultados) if con_indices else resultados
+
+
+class BaseDatosFragmentada(ConjuntoFragmentos):
+    """Reparte las tablas de cada máquina entre varios archivos SQLite según su serial.
+
+    Con un solo fragmento todo vive en ruta_db, como siempre. Con N fragmentos, las
+    tablas de máquinas, slots, inventario, resurtidos, ventas, incidencias y solicitudes de relleno
+    van en <ruta>_fragmento<i>.db (i = serial % N) y el catálogo de productos en
+    <ruta>_catalogo.db, adjunto a cada fragmento. Cada archivo tiene su propio escritor.
+    """
+
+    def __init__(self, ruta: str, num_fragmentos: int = NUM_FRAGMENTOS):
+        self.ruta = ruta
+        if num_fragmentos <= 1:
+            self.catalogo = BaseDatos(PoolConexiones(ruta))
+            super().__init__([self.catalogo])
+        else:
+            base, extension = os.path.splitext(ruta)
+            ruta_catalogo = f"{base}_catalogo{extension}"
+            self.catalogo = BaseDatos(PoolConexiones(ruta_catalogo))
+            super().__init__([BaseDatos(PoolConexiones(f"{base}_fragmento{indice}{extension}", catalogo=ruta_catalogo,
+                                                       fragmento=(indice, num_fragmentos)))
+                              for indice in range(num_fragmentos)])
+        self.instantaneas = [InstantaneaReportes(fragmento) for fragmento in self.fragmentos] if INTERVALO_REPORTES > 0 else []
+
+    @property
+    def bases(self) -> list:
+        return list({id(base): base for base in [self.catalogo] + self.fragmentos}.values())
+
+    def para_reportes(self, fresco: bool = False) -> tuple:
+        """Fragmentos de los que leer un reporte y la antigüedad de sus datos en segundos.
+
+        Se usan las instantáneas salvo que se pidan datos frescos o que alguna supere la
+        antigüedad máxima (p. ej. antes de la primera copia); entonces se lee en vivo.
+        """
+        if not fresco and self.instantaneas:
+            antiguedad = max(instantanea.antiguedad for instantanea in self.instantaneas)
+            if antiguedad <= ANTIGUEDAD_MAXIMA_REPORTES:
+                return ConjuntoFragmentos([instantanea.base for instantanea in self.instantaneas]), antiguedad
+        return self, 0.0
+
+    def migrar(self):
+        if len(self.fragmentos) == 1:
+            migrar_base_datos(self.catalogo.pool.ruta)
+            return
+        if _tiene_datos_de_maquinas(self.ruta):
+            raise RuntimeError(f"{self.ruta} ya tiene datos de máquinas y MAQUINAS_SHARDS={len(self.fragmentos)} "
+                               f"usaría fragmentos vacíos. Arranque con MAQUINAS_SHARDS=1 o reparta antes esa base "
+                               f"en {os.path.basename(self.catalogo.pool.ruta)} y los archivos de fragmento.")
+        migrar_base_datos(self.catalogo.pool.ruta, MIGRACIONES_CATALOGO)
+        for fragmento in self.fragmentos:
+            migrar_base_datos(fragmento.pool.ruta, MIGRACIONES_FRAGMENTO)
+
+    def iniciar_reportes(self):
+        for instantanea in self.instantaneas:
+            instantanea.iniciar()
+
+    async def detener(self):
+        for instantanea in self.instantaneas:
+            await instantanea.detener()
+        for base in self.bases:
+            await base.detener()
+
+    def cerrar(self):
+        for instantanea in self.instantaneas:
+            instantanea.cerrar()
+        for base in self.bases:
+            base.cerrar()
+
+
+def _tiene_datos_de_maquinas(ruta: str) -> bool:
+    """Si la base de un solo archivo en `ruta` existe y tiene máquinas registradas."""
+    if not os.path.exists(ruta):
+        return False
+    conexion = sqlite3.connect(f"file:{ruta}?mode=ro", uri=True)
+    try:
+        if conexion.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'maquinas'").fetchone() is None:
+            return False
+        return conexion.execute("SELECT 1 FROM maquinas LIMIT 1").fetchone() is not None
+    finally:
+        conexion.close()
+
+
+def _siguiente_id(conexion: sqlite3.Connection, tabla: str) -> Optional[int]:
+    """Id nuevo para tablas que se listan de toda la flota: el fragmento i usa ids ≡ i + 1 (mód N).
+
+    Así los ids no se repiten entre fragmentos y se puede paginar por id mezclando fragmentos.
+    Con un solo fragmento devuelve None y SQLite asigna el id como siempre.
+    """
+    indice, total = getattr(conexion, "fragmento", (0, 1))
+    if total == 1:
+        return None
+    # El máximo se lee con el bloqueo tomado para que dos escrituras no elijan el mismo id
+    _tomar_bloqueo_escritura(conexion)
+    maximo = conexion.execute(f"SELECT MAX(id) FROM {tabla}").fetchone()[0]
+    if maximo is None:
+        return indice + 1
+    return maximo + total - (maximo - indice - 1) % total
+
+
+db = BaseDatosFragmentada(ruta_db)
+
+
+# Dependencia de FastAPI: capa de acceso asíncrono a la base de datos
+def obtener_db() -> BaseDatosFragmentada:
+    return db
+
+
+# Paginación por cursor (keyset sobre id) para los listados
+TAMANO_PAGINA_STREAMING = 500
+
+
+def _leer_pagina(conexion: sqlite3.Connection, despues_de: Optional[int], limite: int, *, tabla: str,
+                 columna_maquina: str, serie_maquina: Optional[int] = None,
+                 desde: Optional[str] = None, hasta: Optional[str] = None, columnas: str = "*"):
+    """Lee hasta `limite` filas de `tabla` con id mayor que `despues_de`, en orden de id."""
+    try:
+        condiciones, parametros = ["id > ?"], [despues_de or 0]
+        if serie_maquina is not None:
+            condiciones.append(f"{columna_maquina} = ?")
+            parametros.append(serie_maquina)
+        # "+fecha" no usa los índices por fecha: la página se recorre en orden de id sin ordenar en una tabla temporal
+        if desde is not None:
+            condiciones.append("+fecha >= ?")
+            parametros.append(desde)
+        if hasta is not None:
+            condiciones.append("+fecha <= ?")
+            parametros.append(hasta)
+        cursor = conexion.cursor()
+        cursor.execute(f"SELECT {columnas} FROM {tabla} WHERE {' AND '.join(condiciones)} ORDER BY id LIMIT ?",
+                       parametros + [limite])
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _respuesta_pagina(contenido: list, filas: list, limite: int, cabeceras: Optional[dict] = None) -> RespuestaJSON:
+    # El cursor de la siguiente página va en una cabecera para conservar la lista como cuerpo
+    headers = dict(cabeceras or {})
+    if len(filas) == limite:
+        headers["X-Siguiente-Cursor"] = str(filas[-1][0])
+    return RespuestaJSON(content=contenido, headers=headers)
+
+
+def _cabeceras_reportes(antiguedad: float) -> dict:
+    """Antigüedad de los datos de un reporte y la cota configurada, en segundos."""
+    return {"X-Antiguedad-Datos": f"{antiguedad:.1f}", "X-Antiguedad-Maxima": f"{ANTIGUEDAD_MAXIMA_REPORTES:g}"}
+
+
+async def _leer_pagina_flota(db: ConjuntoFragmentos, lector, despues_de: Optional[int], limite: int,
+                             serie_maquina: Optional[int] = None) -> list:
+    """Página de toda la flota: mezcla por id las páginas de cada fragmento.
+
+    Cada fragmento devuelve sus primeras `limite` filas tras el cursor, así que las `limite`
+    menores de la mezcla son exactamente la página global. Filtrando por máquina basta un fragmento.
+    """
+    fragmentos = db.fragmentos if serie_maquina is None else [db.para_maquina(serie_maquina)]
+    paginas = await asyncio.gather(*(fragmento.ejecutar(lector, despues_de, limite) for fragmento in fragmentos))
+    return sorted(chain.from_iterable(paginas), key=lambda fila: fila[0])[:limite]
+
+
+async def _transmitir_ndjson(db: ConjuntoFragmentos, lector, convertir, despues_de: Optional[int],
+                             serie_maquina: Optional[int] = None):
+    """Recorre todas las páginas y emite una línea JSON por fila, sin acumular el resultado."""
+    while True:
+        filas = await _leer_pagina_flota(db, lector, despues_de, TAMANO_PAGINA_STREAMING, serie_maquina)
+        if filas:
+            yield "".join(_linea_json(convertir(fila)) + "\n" for fila in filas)
+        if len(filas) < TAMANO_PAGINA_STREAMING:
+            return
+        despues_de = filas[-1][0]
+
+# Las estructuras en memoria compartidas entre peticiones (cachés, catálogo, canal de eventos,
+# claves de idempotencia, pronóstico) no llevan bloqueos: solo se tocan desde el bucle de eventos,
+# nunca desde los hilos del ejecutor de consultas.
+
+# Caché de las fichas de estado de cada máquina
+CAPACIDAD_CACHE_ESTADOS = int(os.environ.get("MAQUINAS_CACHE_ESTADOS", "1024"))
+# Las escrituras de otros procesos no invalidan esta caché: una ficha se sirve como mucho este tiempo
+TTL_CACHE_ESTADOS = float(os.environ.get("MAQUINAS_CACHE_ESTADOS_TTL", "1"))
+
+
+class CacheEstados:
+    """Caché LRU en proceso de las respuestas de /maquinas/{serial}/estado.
+
+    Cada escritura que afecta a una máquina la invalida. Una lectura que empezó antes de
+    la invalidación no puede guardar su resultado: se compara la generación de la máquina
+    al empezar y al terminar la consulta. La generación incluye una época global que sube al
+    vaciar la caché, así que también descarta lecturas de máquinas que aún no tenían entrada.
+    Las entradas caducan a los `ttl` segundos para recoger lo escrito por otros procesos.
+    """
+
+    def __init__(self, capacidad: int = CAPACIDAD_CACHE_ESTADOS, ttl: float = TTL_CACHE_ESTADOS):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._generaciones = {}
+        self._epoca = 0
+
+    def obtener(self, serial: int):
+        entrada = self._entradas.get(serial)
+        if entrada is None:
+            return None
+        etag, contenido, caduca = entrada
+        if time.monotonic() >= caduca:
+            del self._entradas[serial]
+            return None
+        self._entradas.move_to_end(serial)
+        return etag, contenido
+
+    def generacion(self, serial: int) -> tuple:
+        return self._epoca, self._generaciones.get(serial, 0)
+
+    def guardar(self, serial: int, generacion: tuple, contenido: dict):
+        etag = '"' + hashlib.sha1(json.dumps(contenido, sort_keys=True, default=str).encode()).hexdigest() + '"'
+        if generacion == self.generacion(serial):
+            self._entradas[serial] = (etag, contenido, time.monotonic() + self.ttl)
+            self._entradas.move_to_end(serial)
+            if len(self._entradas) > self.capacidad:
+                self._entradas.popitem(last=False)
+        return etag, contenido
+
+    def invalidar(self, *seriales: int):
+        for serial in seriales:
+            self._generaciones[serial] = self._generaciones.get(serial, 0) + 1
+            self._entradas.pop(serial, None)
+
+    def limpiar(self):
+        # Cambios en el catálogo afectan a todas las máquinas, tengan o no una entrada guardada
+        self._epoca += 1
+        self._generaciones.clear()
+        self._entradas.clear()
+
+
+cache_estados = CacheEstados()
+
+
+# Catálogo de productos en memoria
+TTL_CATALOGO = float(os.environ.get("MAQUINAS_CATALOGO_TTL", "1"))
+
+
+class CatalogoProductos:
+    """Copia en proceso de la tabla productos: num_serie -> (nombre, precio).
+
+    Las escrituras del propio proceso la invalidan al momento; los cambios hechos por otros
+    procesos se detectan comparando catalogo_version, como mucho una vez cada `ttl` segundos.
+    """
+
+    def __init__(self, ttl: float = TTL_CATALOGO):
+        self.ttl = ttl
+        self.productos = {}
+        self.version = None
+        self._verificado = float("-inf")
+        self._invalidaciones = 0
+
+    async def vigente(self, db) -> dict:
+        if time.monotonic() - self._verificado >= self.ttl:
+            verificado = time.monotonic()
+            invalidaciones = self._invalidaciones
+            version = await db.catalogo.ejecutar(_version_catalogo)
+            if version != self.version:
+                version, productos = await db.catalogo.ejecutar(_leer_catalogo)
+                if self.version is not None:
+                    # Las fichas de estado guardadas llevan nombres y precios del catálogo anterior
+                    cache_estados.limpiar()
+                self.productos, self.version = productos, version
+            # Si hubo una escritura mientras se verificaba, lo leído puede ser anterior a ella
+            if invalidaciones == self._invalidaciones:
+                self._verificado = verificado
+        return self.productos
+
+    def invalidar(self):
+        self._invalidaciones += 1
+        self._verificado = float("-inf")
+
+
+def _version_catalogo(conexion: sqlite3.Connection) -> int:
+    try:
+        return conexion.execute("SELECT version FROM catalogo_version WHERE id = 1").fetchone()[0]
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _leer_catalogo(conexion: sqlite3.Connection) -> tuple:
+    try:
+        # La versión se lee primero: si el catálogo cambia entre ambas consultas, la siguiente verificación lo recarga
+        version = _version_catalogo(conexion)
+        productos = {num_serie: (nombre, precio)
+                     for num_serie, nombre, precio in conexion.execute("SELECT num_serie, nombre, precio FROM productos")}
+        return version, productos
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+catalogo_productos = CatalogoProductos()
+
+
+# Difusión de cambios a los paneles por server-sent events
+CAPACIDAD_SUSCRIPTOR = int(os.environ.get("MAQUINAS_SSE_BUFFER", "256"))
+INTERVALO_LATIDO_SSE = float(os.environ.get("MAQUINAS_SSE_LATIDO_SEGUNDOS", "15"))
+
+
+class Suscriptor:
+    """Un cliente de /eventos/: su filtro y su cola de mensajes ya serializados."""
+
+    def __init__(self, seriales: Optional[set], ubicaciones: set, capacidad: int):
+        self.seriales = seriales  # None: todas las máquinas
+        self.ubicaciones = ubicaciones
+        self.cola = asyncio.Queue(capacidad)
+
+
+class CanalEventos:
+    """Publica cada cambio a los suscriptores cuyo filtro lo incluye.
+
+    Cada evento se serializa una sola vez. Las colas son acotadas: si un suscriptor no lee
+    al ritmo de los cambios se le descarta, en lugar de frenar a quien escribe o acumular
+    memoria.
+    """
+
+    def __init__(self, capacidad: int = CAPACIDAD_SUSCRIPTOR):
+        self.capacidad = capacidad
+        self.suscriptores = set()
+
+    def suscribir(self, seriales: Optional[set], ubicaciones: set) -> Suscriptor:
+        suscriptor = Suscriptor(seriales, ubicaciones, self.capacidad)
+        self.suscriptores.add(suscriptor)
+        return suscriptor
+
+    def cancelar(self, suscriptor: Suscriptor):
+        self.suscriptores.discard(suscriptor)
+
+    def publicar(self, serial: Optional[int], tipo: str, datos: dict):
+        if not self.suscriptores:
+            return
+        evento = dict(datos, tipo=tipo, serial=serial, fecha=datetime.now().isoformat(timespec="seconds"))
+        mensaje = f"event: {tipo}\ndata: {_linea_json(evento)}\n\n"
+        for suscriptor in list(self.suscriptores):
+            # Los cambios sin serial (p. ej. del catálogo) afectan a toda la flota y llegan a todos
+            if serial is not None and suscriptor.seriales is not None and serial not in suscriptor.seriales:
+                if tipo != "alta" or datos.get("ubicacion") not in suscriptor.ubicaciones:
+                    continue
+                suscriptor.seriales.add(serial)
+            try:
+                suscriptor.cola.put_nowait(mensaje)
+            except asyncio.QueueFull:
+                self.descartar(suscriptor)
+
+    def descartar(self, suscriptor: Suscriptor):
+        """Libera la cola del suscriptor y deja solo la marca de fin; su flujo termina al leerla."""
+        self.cancelar(suscriptor)
+        while not suscriptor.cola.empty():
+            suscriptor.cola.get_nowait()
+        suscriptor.cola.put_nowait(None)
+        metricas.incrementar("maquinas_sse_descartados_total")
+
+
+canal_eventos = CanalEventos()
+
+
+def notificar_cambio(serial: Optional[int], tipo: str, **datos):
+    """Invalida la ficha de estado afectada por una escritura y publica el cambio en /eventos/.
+
+    Sin serial el cambio afecta a toda la flota: se vacía la caché de estados completa.
+    """
+    if serial is None:
+        cache_estados.limpiar()
+    else:
+        cache_estados.invalidar(serial)
+    canal_eventos.publicar(serial, tipo, datos)
+
+
+# Claves de idempotencia para los reintentos de ventas y resurtidos
+CAPACIDAD_IDEMPOTENCIA = int(os.environ.get("MAQUINAS_IDEMPOTENCIA_CAPACIDAD", "10000"))
+TTL_IDEMPOTENCIA = int(os.environ.get("MAQUINAS_IDEMPOTENCIA_TTL", "86400"))
+INTERVALO_PURGA_IDEMPOTENCIA = float(os.environ.get("MAQUINAS_IDEMPOTENCIA_PURGA_SEGUNDOS", "3600"))
+LONGITUD_MAXIMA_CLAVE = 255
+TAMANO_BLOQUE_PURGA = 5000
+
+
+class CacheIdempotencia:
+    """Respuestas ya dadas por (ruta, máquina, clave), para contestar los reintentos sin volver a escribir.
+
+    En memoria hay un LRU acotado con caducidad; la tabla claves_idempotencia, escrita en la
+    misma transacción que la venta o el resurtido, da durabilidad entre reinicios y cubre lo
+    que el LRU ya desalojó. Un reintento que llega mientras la petición original sigue en curso
+    espera su resultado. Solo se guardan las escrituras que se confirmaron: una que falló no
+    tuvo efecto y su reintento se vuelve a ejecutar.
+    """
+
+    def __init__(self, capacidad: int = CAPACIDAD_IDEMPOTENCIA, ttl: int = TTL_IDEMPOTENCIA):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self._entradas = OrderedDict()  # (ruta, serial, clave) -> (caduca, huella, respuesta)
+        self._en_curso = {}  # (ruta, serial, clave) -> (huella, futuro)
+        self._purga = None
+
+    async def escribir(self, base: BaseDatos, ruta: str, serial: int, clave: Optional[str], parametros: dict,
+                       funcion, *args) -> tuple:
+        """Ejecuta la escritura salvo que la clave ya tenga respuesta; devuelve (respuesta, si es repetida)."""
+        if clave is None:
+            return await base.escribir(funcion, *args), False
+        if not clave or len(clave) > LONGITUD_MAXIMA_CLAVE:
+            raise HTTPException(status_code=400, detail=f"La clave de idempotencia debe tener de 1 a {LONGITUD_MAXIMA_CLAVE} caracteres")
+        llave = (ruta, serial, clave)
+        huella = hashlib.sha1(json.dumps(parametros, sort_keys=True).encode()).hexdigest()
+
+        entrada = self._entradas.get(llave)
+        if entrada is not None and entrada[0] > time.time():
+            self._entradas.move_to_end(llave)
+            return self._repetida(entrada[1], huella, entrada[2], ruta, "memoria")
+        en_curso = self._en_curso.get(llave)
+        if en_curso is not None:
+            # shield: si este reintento se cancela, la petición original no se ve afectada
+            return self._repetida(en_curso[0], huella, await asyncio.shield(en_curso[1]), ruta, "en_curso")
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._en_curso[llave] = (huella, futuro)
+        try:
+            respuesta, repetida = await base.escribir(_escribir_idempotente, llave, huella, self.ttl, funcion, args)
+            self._guardar(llave, time.time() + self.ttl, huella, respuesta)
+            futuro.set_result(respuesta)
+        except BaseException as e:
+            futuro.set_exception(e)
+            futuro.exception()  # Sin reintentos esperando, evita el aviso de excepción no recuperada
+            raise
+        finally:
+            del self._en_curso[llave]
+        return self._repetida(huella, huella, respuesta, ruta, "base") if repetida else (respuesta, False)
+
+    @staticmethod
+    def _repetida(huella_original: str, huella: str, respuesta: dict, ruta: str, origen: str) -> tuple:
+        if huella != huella_original:
+            raise HTTPException(status_code=422, detail="La clave de idempotencia ya se usó con otros parámetros")
+        metricas.incrementar("maquinas_idempotencia_repetidas_total", (("ruta", ruta), ("origen", origen)))
+        return respuesta, True
+
+    def _guardar(self, llave: tuple, caduca: float, huella: str, respuesta: dict):
+        self._entradas[llave] = (caduca, huella, respuesta)
+        self._entradas.move_to_end(llave)
+        while len(self._entradas) > self.capacidad:
+            self._entradas.popitem(last=False)
+
+    async def cargar(self, db: BaseDatosFragmentada):
+        """Precarga las claves más recientes, para que los reintentos tras un reinicio no lleguen a la base."""
+        parciales = await db.en_todos(_leer_claves_recientes, int(time.time()) - self.ttl, self.capacidad)
+        # Las más antiguas se insertan primero, para que sean las primeras en desalojarse
+        filas = sorted((fila for parcial in parciales for fila in parcial), key=lambda fila: fila[5])
+        for ruta, serial, clave, huella, respuesta, creada in filas[-self.capacidad:]:
+            self._guardar((ruta, serial, clave), creada + self.ttl, huella, json.loads(respuesta))
+
+    def iniciar_purga(self, db: BaseDatosFragmentada, intervalo: float = INTERVALO_PURGA_IDEMPOTENCIA):
+        if self._purga is None and intervalo > 0:
+            self._purga = asyncio.create_task(self._bucle_purga(db, intervalo))
+
+    async def _bucle_purga(self, db: BaseDatosFragmentada, intervalo: float):
+        while True:
+            await asyncio.sleep(intervalo)
+            try:
+                for fragmento in db.fragmentos:
+                    # Por bloques, para no retener el bloqueo de escritura frente a las ventas
+                    while await fragmento.escribir(_purgar_claves, int(time.time()) - self.ttl) == TAMANO_BLOQUE_PURGA:
+                        pass
+            except HTTPException as e:
+                print("Error al purgar las claves de idempotencia:", e.detail)
+
+    async def detener(self):
+        if self._purga is not None:
+            self._purga.cancel()
+            try:
+                await self._purga
+            except asyncio.CancelledError:
+                pass
+            self._purga = None
+
+
+def _escribir_idempotente(conexion: sqlite3.Connection, llave: tuple, huella: str, ttl: int, funcion, args) -> tuple:
+    """Dentro de la transacción de escritura: la respuesta guardada para la clave o la de ejecutar la escritura."""
+    try:
+        # La clave se busca con el bloqueo tomado: otra conexión no puede guardarla entre la búsqueda y la escritura
+        _tomar_bloqueo_escritura(conexion)
+        ahora = int(time.time())
+        fila = conexion.execute("SELECT huella, respuesta FROM claves_idempotencia "
+                                "WHERE ruta = ? AND serie_maquina = ? AND clave = ? AND creada > ?", llave + (ahora - ttl,)).fetchone()
+        if fila is not None:
+            if fila[0] != huella:
+                raise HTTPException(status_code=422, detail="La clave de idempotencia ya se usó con otros parámetros")
+            return json.loads(fila[1]), True
+        respuesta = funcion(conexion, *args)
+        # Una clave caducada que aún no se purgó se reutiliza
+        conexion.execute("INSERT INTO claves_idempotencia (ruta, serie_maquina, clave, huella, respuesta, creada) "
+                         "VALUES (?, ?, ?, ?, ?, ?) "
+                         "ON CONFLICT (ruta, serie_maquina, clave) DO UPDATE SET "
+                         "huella = excluded.huella, respuesta = excluded.respuesta, creada = excluded.creada",
+                         llave + (huella, json.dumps(respuesta), ahora))
+        return respuesta, False
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _leer_claves_recientes(conexion: sqlite3.Connection, desde: int, limite: int) -> list:
+    try:
+        return conexion.execute("SELECT ruta, serie_maquina, clave, huella, respuesta, creada FROM claves_idempotencia "
+                                "WHERE creada > ? ORDER BY creada DESC LIMIT ?", (desde, limite)).fetchall()
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _purgar_claves(conexion: sqlite3.Connection, hasta: int) -> int:
+    try:
+        cursor = conexion.execute("DELETE FROM claves_idempotencia WHERE (ruta, serie_maquina, clave) IN ("
+                                  "  SELECT ruta, serie_maquina, clave FROM claves_idempotencia WHERE creada <= ? LIMIT ?)",
+                                  (hasta, TAMANO_BLOQUE_PURGA))
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+claves_idempotencia = CacheIdempotencia()
+
+
+def _etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    etiquetas = [etiqueta.strip().removeprefix("W/") for etiqueta in if_none_match.split(",")]
+    return "*" in etiquetas or etag in etiquetas
+
+
+def _campos_solicitados(fields: Optional[str], disponibles) -> Optional[list]:
+    """Valida el parámetro `fields` (nombres separados por comas); None si no se pidió proyección."""
+    if fields is None:
+        return None
+    campos = list(dict.fromkeys(campo.strip() for campo in fields.split(",") if campo.strip()))
+    desconocidos = [campo for campo in campos if campo not in disponibles]
+    if desconocidos or not campos:
+        raise HTTPException(status_code=400, detail=f"Campos no válidos en fields={fields!r}. "
+                                                    f"Disponibles: {', '.join(disponibles)}")
+    return campos
 
-    cursor.close()
-    conexion.close()
-except Exception as e:
-    print("Error al conectar y crear la base de datos:", e)
 
 class Producto(BaseModel):
     num_serie:int
@@ -132,10 +1532,23 @@ class MaquinaExpendedora(BaseModel):
     capacidad_por_slot: int = 10
     slots: List[Slot] = []
 
+# Cotas del alta masiva. MAX_SLOTS_POR_LOTE limita las filas de slots que un lote inserta en una sola
+# transacción; sin ella, MAX_MAQUINAS_POR_LOTE máquinas con el máximo de slots serían millones de filas
+MAX_SLOTS_POR_MAQUINA = 200
+MAX_CAPACIDAD_POR_SLOT = 1000
+MAX_SLOTS_POR_LOTE = 100_000
+
+class AltaMaquina(BaseModel):
+    serial: int
+    ubicacion: str
+    direccion: str
+    num_slots: int = Field(30, ge=1, le=MAX_SLOTS_POR_MAQUINA)
+    capacidad_por_slot: int = Field(10, ge=1, le=MAX_CAPACIDAD_POR_SLOT)
+
 class Venta(BaseModel):
     id_maquina: int
     num_serie: int
-    cantidad: int = 1
+    cantidad: int = Field(1, ge=1)
     num_slot: Optional[int] = None
 
 class Incidencia(BaseModel):
@@ -144,10 +1557,33 @@ class Incidencia(BaseModel):
     serie_maquina: int
     nombre_persona: str
 
+CAMPOS_ESTADO = ["serial", "ubicacion", "direccion", "estado", "productos", "numero_de_slots", "capacidad_de_cada_slot",
+                 "incidencias", "ganancia_total_ventas", "solicitudes_relleno"]
+
+
 @app.get("/maquinas/{serial}/estado")
-async def obtener_informacion_maquina(serial: int):
+async def obtener_informacion_maquina(serial: int, if_none_match: Optional[str] = Header(None),
+                                      fields: Optional[str] = None, db: BaseDatosFragmentada = Depends(obtener_db)):
+    campos = _campos_solicitados(fields, CAMPOS_ESTADO)
+    entrada = cache_estados.obtener(serial)
+    if entrada is None:
+        generacion = cache_estados.generacion(serial)
+        productos = await catalogo_productos.vigente(db)
+        contenido = await db.para_maquina(serial).ejecutar(_obtener_informacion_maquina, serial, productos)
+        entrada = cache_estados.guardar(serial, generacion, contenido)
+
+    etag, contenido = entrada
+    if campos is not None:
+        # La proyección sale de la ficha completa en caché; su ETag depende también de los campos
+        contenido = {campo: contenido[campo] for campo in campos}
+        etag = f'{etag[:-1]};{"+".join(campos)}"'
+    if _etag_coincide(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return RespuestaJSON(content=contenido, headers={"ETag": etag})
+
+
+def _obtener_informacion_maquina(conexion: sqlite3.Connection, serial: int, catalogo: dict):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         cursor.execute("SELECT serial, ubicacion, direccion, estado FROM maquinas WHERE serial=?", (serial,))
@@ -155,10 +1591,11 @@ async def obtener_informacion_maquina(serial: int):
         if not maquina_info:
             raise HTTPException(status_code=404, detail="La máquina no existe")
 
-        cursor.execute("SELECT p.num_serie, p.nombre, p.precio, r.cantidad, r.num_slot FROM productos p "
-                       "INNER JOIN resurtidos r ON p.num_serie = r.num_serie AND r.serie_maquina = ?", (serial,))
-        productos = [{"num_serie": row[0], "nombre": row[1], "precio": row[2], "cantidad": row[3], "num_slot": row[4]}
-                     for row in cursor.fetchall()]
+        # Nombre y precio salen del catálogo en memoria; los productos que ya no existen se omiten
+        cursor.execute("SELECT num_serie, cantidad, num_slot FROM inventario WHERE serie_maquina = ?", (serial,))
+        productos = [{"num_serie": row[0], "nombre": catalogo[row[0]][0], "precio": catalogo[row[0]][1],
+                      "cantidad": row[1], "num_slot": row[2]}
+                     for row in cursor.fetchall() if row[0] in catalogo]
 
         cursor.execute("SELECT num_slot, capacidad_maxima FROM slots WHERE serial_maquina=?", (serial,))
         slots_info = cursor.fetchall()
@@ -169,10 +1606,9 @@ async def obtener_informacion_maquina(serial: int):
         cursor.execute("SELECT * FROM solicitudes_relleno WHERE num_serie_maquina=?", (serial,))
         solicitudes_relleno = [{"id_informe": row[0], "num_serie_maquina": row[2], "productos_restantes": row[3], "fecha": row[4], "hora": row[5]} for row in cursor.fetchall()]
 
-        cursor.execute("SELECT SUM(monto) AS ganancia_total FROM ventas WHERE serie_maquina=?", (serial,))
-        ganancia_total_venta = cursor.fetchone()[0] or 0
-        cursor.close()
-        conexion.close()
+        cursor.execute("SELECT total FROM ventas_por_maquina WHERE serie_maquina=?", (serial,))
+        ganancia_total_venta = cursor.fetchone()
+        ganancia_total_venta = ganancia_total_venta[0] if ganancia_total_venta else 0
 
         num_slots = len(slots_info)
         capacidad_por_slot = sum(slot[1] for slot in slots_info) if slots_info else 0
@@ -200,13 +1636,72 @@ async def obtener_informacion_maquina(serial: int):
 
  
 
+MAX_MAQUINAS_POR_LOTE = 20000
+
+
+# Alta masiva de máquinas; debe declararse antes de /maquinas/{serial} para que "lote" no se tome como serial
+@app.post("/maquinas/lote")
+async def crear_maquinas_lote(maquinas: List[AltaMaquina], db: BaseDatosFragmentada = Depends(obtener_db)):
+    if len(maquinas) > MAX_MAQUINAS_POR_LOTE:
+        raise HTTPException(status_code=400, detail=f"El lote no puede tener más de {MAX_MAQUINAS_POR_LOTE} máquinas")
+    if sum(maquina.num_slots for maquina in maquinas) > MAX_SLOTS_POR_LOTE:
+        raise HTTPException(status_code=400, detail=f"El lote no puede crear más de {MAX_SLOTS_POR_LOTE} slots")
+    resultado = {"creadas": [], "conflictos": []}
+    for parcial in await db.por_fragmento(_crear_maquinas_lote, maquinas, lambda maquina: maquina.serial):
+        resultado["creadas"].extend(parcial["creadas"])
+        resultado["conflictos"].extend(parcial["conflictos"])
+    # Con seriales repetidos se crea la primera aparición
+    altas = {maquina.serial: maquina for maquina in reversed(maquinas)}
+    for serial in resultado["creadas"]:
+        notificar_cambio(serial, "alta", ubicacion=altas[serial].ubicacion, direccion=altas[serial].direccion)
+    return resultado
+
+
+def _crear_maquinas_lote(conexion: sqlite3.Connection, maquinas: List[AltaMaquina]):
+    try:
+        cursor = conexion.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        existentes = set()
+        for bloque in _en_bloques({maquina.serial for maquina in maquinas}):
+            cursor.execute(f"SELECT serial FROM maquinas WHERE serial IN ({','.join('?' * len(bloque))})", bloque)
+            existentes.update(row[0] for row in cursor.fetchall())
+
+        # Los seriales ya registrados o repetidos en el lote se reportan como conflicto sin abortar el lote
+        nuevas, conflictos, vistos = [], [], set()
+        for maquina in maquinas:
+            if maquina.serial in existentes:
+                conflictos.append({"serial": maquina.serial, "detalle": "Máquina ya existente, pruebe otro ID serial."})
+            elif maquina.serial in vistos:
+                conflictos.append({"serial": maquina.serial, "detalle": "Serial repetido en el lote, solo se crea su primera aparición."})
+            else:
+                vistos.add(maquina.serial)
+                nuevas.append(maquina)
+
+        cursor.executemany("INSERT INTO maquinas (serial, ubicacion, direccion) VALUES (?, ?, ?)",
+                           [(maquina.serial, maquina.ubicacion, maquina.direccion) for maquina in nuevas])
+        cursor.executemany("INSERT INTO slots (serial_maquina, num_slot, capacidad_maxima) VALUES (?, ?, ?)",
+                           ((maquina.serial, num, maquina.capacidad_por_slot)
+                            for maquina in nuevas for num in range(maquina.num_slots)))
+        conexion.commit()
+
+        return {"creadas": [maquina.serial for maquina in nuevas], "conflictos": conflictos}
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/maquinas/{serial}")
-async def crear_maquina(serial: int, ubicacion: str, direccion: str):
+async def crear_maquina(serial: int, ubicacion: str, direccion: str, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(serial).ejecutar(_crear_maquina, serial, ubicacion, direccion)
+    notificar_cambio(serial, "alta", ubicacion=ubicacion, direccion=direccion)
+    return resultado
+
+
+def _crear_maquina(conexion: sqlite3.Connection, serial: int, ubicacion: str, direccion: str):
     try:
         # Crear una instancia de MaquinaExpendedora
         maquina_expendedora = MaquinaExpendedora(serial=serial, ubicacion=ubicacion, direccion=direccion, estado='apagada')
 
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         # Verificar si ya existe una máquina con el mismo ID serial
@@ -226,9 +1721,6 @@ async def crear_maquina(serial: int, ubicacion: str, direccion: str):
         return {"mensaje": "Máquina registrada correctamente", "serial": maquina_expendedora.serial}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
         
 
 
@@ -239,17 +1731,19 @@ async def crear_maquina(serial: int, ubicacion: str, direccion: str):
 
 # Método para encender una máquina
 @app.post("/encender_maquina/{serial}")
-async def encender_maquina(serial: int):
+async def encender_maquina(serial: int, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(serial).escribir(_encender_maquina, serial)
+    notificar_cambio(serial, "estado", estado="encendida")
+    return resultado
+
+
+def _encender_maquina(conexion: sqlite3.Connection, serial: int):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
         cursor.execute("SELECT * FROM maquinas WHERE serial=?", (serial,))
         maquina = cursor.fetchone()
         if maquina:
             cursor.execute("UPDATE maquinas SET estado='encendida' WHERE serial=?", (serial,))
-            conexion.commit()
-            cursor.close()
-            conexion.close()
             return {"mensaje": "Máquina encendida"}
         else:
             raise HTTPException(status_code=404, detail="La máquina no existe")
@@ -259,17 +1753,19 @@ async def encender_maquina(serial: int):
 
 # Método para apagar una máquina
 @app.post("/apagar_maquina/{serial}")
-async def apagar_maquina(serial: int):
+async def apagar_maquina(serial: int, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(serial).escribir(_apagar_maquina, serial)
+    notificar_cambio(serial, "estado", estado="apagada")
+    return resultado
+
+
+def _apagar_maquina(conexion: sqlite3.Connection, serial: int):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
         cursor.execute("SELECT * FROM maquinas WHERE serial=?", (serial,))
         maquina = cursor.fetchone()
         if maquina:
             cursor.execute("UPDATE maquinas SET estado='apagada' WHERE serial=?", (serial,))
-            conexion.commit()
-            cursor.close()
-            conexion.close()
             return {"mensaje": "Máquina apagada correctamente"}
         else:
             raise HTTPException(status_code=404, detail="La máquina no existe")
@@ -279,9 +1775,14 @@ async def apagar_maquina(serial: int):
 
 # Método para eliminar una máquina
 @app.delete("/maquinas/{serial}")
-async def eliminar_maquina(serial: int):
+async def eliminar_maquina(serial: int, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(serial).ejecutar(_eliminar_maquina, serial)
+    notificar_cambio(serial, "baja")
+    return resultado
+
+
+def _eliminar_maquina(conexion: sqlite3.Connection, serial: int):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
         
         # Verificar si la máquina existe
@@ -290,41 +1791,46 @@ async def eliminar_maquina(serial: int):
         if not maquina:
             raise HTTPException(status_code=404, detail="La máquina no existe")
         
-        # Eliminar la máquina
+        # Eliminar la máquina y sus existencias vigentes; la bitácora de resurtidos se conserva
         cursor.execute("DELETE FROM maquinas WHERE serial=?", (serial,))
+        cursor.execute("DELETE FROM inventario WHERE serie_maquina=?", (serial,))
         conexion.commit()
         
         return {"mensaje": "Máquina eliminada correctamente"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
         
 
         
 
 
 @app.get("/productos/{serial_maquina}")
-async def leer_productos(serial_maquina: int):
+async def leer_productos(serial_maquina: int, fields: Optional[str] = None, db: BaseDatosFragmentada = Depends(obtener_db)):
+    campos = _campos_solicitados(fields, CAMPOS_PRODUCTO_MAQUINA)
+    productos = await catalogo_productos.vigente(db)
+    return RespuestaJSON(await db.para_maquina(serial_maquina).ejecutar(_leer_productos, serial_maquina, productos, campos))
+
+
+CAMPOS_PRODUCTO_MAQUINA = ["num_serie", "nombre", "precio", "cantidad", "num_slot"]
+
+
+def _leer_productos(conexion: sqlite3.Connection, serial_maquina: int, catalogo: dict, campos: Optional[list] = None):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
-        cursor.execute("SELECT p.num_serie, p.nombre, p.precio, r.cantidad, r.num_slot \
-                        FROM productos p \
-                        INNER JOIN resurtidos r ON p.num_serie = r.num_serie AND r.serie_maquina = ?",
-                       (serial_maquina,))
-        resultados = cursor.fetchall()
+        cursor.execute("SELECT num_serie, cantidad, num_slot FROM inventario WHERE serie_maquina = ?", (serial_maquina,))
+        resultados = [(row[0], *catalogo[row[0]], row[1], row[2]) for row in cursor.fetchall() if row[0] in catalogo]
+        if campos is not None:
+            posiciones = [CAMPOS_PRODUCTO_MAQUINA.index(campo) for campo in campos]
+            resultados = [tuple(row[posicion] for posicion in posiciones) for row in resultados]
         
         # Calcular la cantidad total de productos en la máquina
-        cursor.execute("SELECT SUM(cantidad) FROM resurtidos WHERE serie_maquina=?", (serial_maquina,))
+        cursor.execute("SELECT SUM(cantidad) FROM inventario WHERE serie_maquina=?", (serial_maquina,))
         cantidad_total = cursor.fetchone()[0] or 0  # Si no hay resultados, establecer la cantidad total en 0
         
-        cursor.close()
-        conexion.close()
         
         if resultados:
-            return {"productos": [{"num_serie": row[0], "nombre": row[1], "precio": row[2], "cantidad": row[3], "num_slot": row[4]} for row in resultados],
+            nombres = campos or CAMPOS_PRODUCTO_MAQUINA
+            return {"productos": [dict(zip(nombres, row)) for row in resultados],
                     "cantidad total de productos": cantidad_total}
         else:
             raise HTTPException(status_code=404, detail="No se encontraron productos para esta máquina.")
@@ -335,32 +1841,49 @@ async def leer_productos(serial_maquina: int):
 
 
 @app.post("/resurtir/")
-async def resurtir_producto(serie_maquina: int, num_serie: int, cantidad: int, num_slot: int):
+async def resurtir_producto(respuesta: Response, serie_maquina: int, num_serie: int, cantidad: int, num_slot: int,
+                            idempotency_key: Optional[str] = Header(None), db: BaseDatosFragmentada = Depends(obtener_db)):
+    parametros = {"serie_maquina": serie_maquina, "num_serie": num_serie, "cantidad": cantidad, "num_slot": num_slot}
+    resultado, repetida = await claves_idempotencia.escribir(db.para_maquina(serie_maquina), "/resurtir/", serie_maquina,
+                                                             idempotency_key, parametros, _resurtir_producto,
+                                                             serie_maquina, num_serie, cantidad, num_slot)
+    if repetida:
+        respuesta.headers["Idempotent-Replayed"] = "true"
+    else:
+        notificar_cambio(serie_maquina, "resurtido", num_serie=num_serie, num_slot=num_slot, cantidad=cantidad)
+    return resultado
+
+
+def _resurtir_producto(conexion: sqlite3.Connection, serie_maquina: int, num_serie: int, cantidad: int, num_slot: int):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
+
+        if cantidad <= 0:
+            raise HTTPException(status_code=400, detail="La cantidad a resurtir debe ser mayor que cero")
+        cursor.execute("SELECT 1 FROM slots s JOIN maquinas m ON m.serial = s.serial_maquina "
+                       "WHERE s.serial_maquina=? AND s.num_slot=?", (serie_maquina, num_slot))
+        if cursor.fetchone() is None:
+            raise HTTPException(status_code=404, detail="La máquina no existe o no tiene ese slot")
+
+        # Sumar al slot si ya tiene este producto; un slot vacío puede cambiar de producto
+        fecha = datetime.now()
+        cursor.execute("INSERT INTO inventario (serie_maquina, num_slot, num_serie, cantidad, ultimo_resurtido) VALUES (?, ?, ?, ?, ?) "
+                       "ON CONFLICT (serie_maquina, num_slot) DO UPDATE SET "
+                       "  cantidad = CASE WHEN num_serie = excluded.num_serie THEN cantidad + excluded.cantidad ELSE excluded.cantidad END, "
+                       "  num_serie = excluded.num_serie, ultimo_resurtido = excluded.ultimo_resurtido "
+                       "WHERE num_serie = excluded.num_serie OR cantidad = 0",
+                       (serie_maquina, num_slot, num_serie, cantidad, fecha))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=409, detail="El slot tiene existencias de otro producto; debe vaciarse antes de cambiarlo")
+
+        # Registrar el resurtido en la bitácora
+        cursor.execute("INSERT INTO resurtidos (serie_maquina, num_serie, cantidad, fecha, num_slot) VALUES (?, ?, ?, ?, ?)",
+                       (serie_maquina, num_serie, cantidad, fecha, num_slot))
         
-        # Verificar si ya existe un registro para este producto en el mismo slot
-        cursor.execute("SELECT * FROM resurtidos WHERE serie_maquina=? AND num_serie=? AND num_slot=?", 
-                       (serie_maquina, num_serie, num_slot))
-        producto_existente = cursor.fetchone()
-        
-        if producto_existente:
-            # Si ya existe, actualizar la cantidad
-            cursor.execute("UPDATE resurtidos SET cantidad = cantidad + ? WHERE serie_maquina = ? AND num_serie = ? AND num_slot = ?",
-                           (cantidad, serie_maquina, num_serie, num_slot))
-        else:
-            # Si no existe, insertar un nuevo registro
-            cursor.execute("INSERT INTO resurtidos (serie_maquina, num_serie, cantidad, fecha, num_slot) VALUES (?, ?, ?, ?, ?)",
-                           (serie_maquina, num_serie, cantidad, datetime.now(), num_slot))
-        
-        conexion.commit()
+        # La transacción la confirma BaseDatos.escribir, sola o agrupada con otras escrituras
         return {"mensaje": "Productos resurtidos correctamente en el slot especificado"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
 
 
 
@@ -376,15 +1899,23 @@ async def resurtir_producto(serie_maquina: int, num_serie: int, cantidad: int, n
 
 
 # Rutas para obtener información de las ventas
+# Sin "mes" se considera todo el historial; con "mes" (AAAA-MM) solo las ventas de ese mes
 @app.get("/MontoMensualMasAlto/")
-async def ingreso_mensual_mas_alto():
+async def ingreso_mensual_mas_alto(respuesta: Response, mes: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+                                   fresco: bool = False, db: BaseDatosFragmentada = Depends(obtener_db)):
+    fuente, antiguedad = db.para_reportes(fresco)
+    respuesta.headers.update(_cabeceras_reportes(antiguedad))
+    return _elegir_monto(await fuente.en_todos(_ingreso_mensual_mas_alto, mes), max)
+
+
+def _ingreso_mensual_mas_alto(conexion: sqlite3.Connection, mes: Optional[str]):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
-        cursor.execute("SELECT serie_maquina, SUM(monto) AS total FROM ventas GROUP BY serie_maquina ORDER BY total DESC LIMIT 1")
+        if mes is None:
+            cursor.execute("SELECT serie_maquina, total FROM ventas_por_maquina ORDER BY total DESC LIMIT 1")
+        else:
+            cursor.execute("SELECT serie_maquina, total FROM ventas_por_mes WHERE mes=? ORDER BY total DESC LIMIT 1", (mes,))
         resultado = cursor.fetchone()
-        cursor.close()
-        conexion.close()
         if resultado:
             id_maquina_mas_alta = resultado[0]
             monto_total_mas_alto = resultado[1]
@@ -396,14 +1927,21 @@ async def ingreso_mensual_mas_alto():
 
 
 @app.get("/MontoMensualMasBajo/")
-async def ingreso_mensual_mas_bajo():
+async def ingreso_mensual_mas_bajo(respuesta: Response, mes: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+                                   fresco: bool = False, db: BaseDatosFragmentada = Depends(obtener_db)):
+    fuente, antiguedad = db.para_reportes(fresco)
+    respuesta.headers.update(_cabeceras_reportes(antiguedad))
+    return _elegir_monto(await fuente.en_todos(_ingreso_mensual_mas_bajo, mes), min)
+
+
+def _ingreso_mensual_mas_bajo(conexion: sqlite3.Connection, mes: Optional[str]):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
-        cursor.execute("SELECT serie_maquina, SUM(monto) AS total FROM ventas GROUP BY serie_maquina ORDER BY total ASC LIMIT 1")
+        if mes is None:
+            cursor.execute("SELECT serie_maquina, total FROM ventas_por_maquina ORDER BY total ASC LIMIT 1")
+        else:
+            cursor.execute("SELECT serie_maquina, total FROM ventas_por_mes WHERE mes=? ORDER BY total ASC LIMIT 1", (mes,))
         resultado = cursor.fetchone()
-        cursor.close()
-        conexion.close()
         if resultado:
             id_maquina_mas_baja = resultado[0]
             monto_total_mas_bajo = resultado[1]
@@ -414,18 +1952,36 @@ async def ingreso_mensual_mas_bajo():
         raise HTTPException(status_code=500, detail=str(e))
     
     
+def _elegir_monto(resultados: list, criterio):
+    """Combina las respuestas de cada fragmento quedándose con la máquina de mayor o menor monto."""
+    con_ventas = [resultado for resultado in resultados if "monto_total" in resultado]
+    if not con_ventas:
+        return {"mensaje": "No hay datos de ventas"}
+    return criterio(con_ventas, key=lambda resultado: resultado["monto_total"])
+
+
 # Gestion para información de las ventas
+# Opcionalmente limitada a un mes (AAAA-MM) o a un día (AAAA-MM-DD)
 @app.get("/ganancia-total-ventas/{serial_maquina}")
-async def obtener_ganancia_total_ventas(serial_maquina: int):
+async def obtener_ganancia_total_ventas(serial_maquina: int,
+                                        mes: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+                                        dia: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+                                        db: BaseDatosFragmentada = Depends(obtener_db)):
+    return await db.para_maquina(serial_maquina).ejecutar(_obtener_ganancia_total_ventas, serial_maquina, mes, dia)
+
+
+def _obtener_ganancia_total_ventas(conexion: sqlite3.Connection, serial_maquina: int, mes: Optional[str], dia: Optional[str]):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
-        cursor.execute("SELECT SUM(monto) AS ganancia_total FROM ventas WHERE serie_maquina=?", (serial_maquina,))
-        ganancia_total_venta = cursor.fetchone()[0] or 0
-
-        cursor.close()
-        conexion.close()
+        if dia is not None:
+            cursor.execute("SELECT total FROM ventas_por_dia WHERE serie_maquina=? AND dia=?", (serial_maquina, dia))
+        elif mes is not None:
+            cursor.execute("SELECT total FROM ventas_por_mes WHERE serie_maquina=? AND mes=?", (serial_maquina, mes))
+        else:
+            cursor.execute("SELECT total FROM ventas_por_maquina WHERE serie_maquina=?", (serial_maquina,))
+        ganancia_total_venta = cursor.fetchone()
+        ganancia_total_venta = ganancia_total_venta[0] if ganancia_total_venta else 0
 
         return {"ganancia_total_ventas": ganancia_total_venta}
     except sqlite3.Error as e:
@@ -436,9 +1992,15 @@ async def obtener_ganancia_total_ventas(serial_maquina: int):
 from fastapi import HTTPException
 
 @app.post("/incidencias/")
-async def crear_incidencia(descripcion: str, serie_maquina: int, nombre_persona: str):
+async def crear_incidencia(descripcion: str, serie_maquina: int, nombre_persona: str, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(serie_maquina).escribir(_crear_incidencia, descripcion, serie_maquina, nombre_persona)
+    notificar_cambio(serie_maquina, "incidencia", id_incidencia=resultado["id_incidencia"], descripcion=descripcion,
+                     nombre_persona=nombre_persona)
+    return resultado
+
+
+def _crear_incidencia(conexion: sqlite3.Connection, descripcion: str, serie_maquina: int, nombre_persona: str):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
         
         # Verificar si la máquina existe
@@ -449,15 +2011,12 @@ async def crear_incidencia(descripcion: str, serie_maquina: int, nombre_persona:
         
         # Registrar la incidencia
         fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute("INSERT INTO incidencias (descripcion, serie_maquina, fecha, nombre_persona) VALUES (?, ?, ?, ?)",
-                       (descripcion, serie_maquina, fecha_actual, nombre_persona))
-        conexion.commit()
+        cursor.execute("INSERT INTO incidencias (id, descripcion, serie_maquina, fecha, nombre_persona) VALUES (?, ?, ?, ?, ?)",
+                       (_siguiente_id(conexion, "incidencias"), descripcion, serie_maquina, fecha_actual, nombre_persona))
         
-        # Obtener el ID de la incidencia recién insertada
+        # Obtener el ID de la incidencia recién insertada; la transacción la confirma BaseDatos.escribir
         id_incidencia = cursor.lastrowid
         
-        cursor.close()
-        conexion.close()
         
         return {"mensaje": "Incidencia registrada", "id_incidencia": id_incidencia}
     except sqlite3.Error as e:
@@ -469,9 +2028,14 @@ async def crear_incidencia(descripcion: str, serie_maquina: int, nombre_persona:
 
 
 @app.delete("/incidencias/{id_maquina}")
-async def eliminar_incidencia(id_maquina: int):
+async def eliminar_incidencia(id_maquina: int, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(id_maquina).ejecutar(_eliminar_incidencia, id_maquina)
+    notificar_cambio(id_maquina, "incidencias_eliminadas")
+    return resultado
+
+
+def _eliminar_incidencia(conexion: sqlite3.Connection, id_maquina: int):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
         
         # Verificar si la máquina existe
@@ -487,30 +2051,49 @@ async def eliminar_incidencia(id_maquina: int):
         return {"mensaje": "Todas las incidencias asociadas a la máquina han sido eliminadas"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
+
+
+# Listado paginado de incidencias; formato=ndjson transmite todas las filas restantes
 @app.get("/incidencias/")
-async def leer_incidencias():
-    try:
-        conexion = sqlite3.connect(ruta_db)
-        cursor = conexion.cursor()
-        cursor.execute("SELECT * FROM incidencias")
-        resultados = cursor.fetchall()
-        
-        cursor.close()
-        conexion.close()
-        
-        return [{"id": row[0], "descripcion": row[1], "id_maquina": row[2], "fecha": row[3], "nombre_persona": row[4]} for row in resultados]
-    except sqlite3.Error as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def leer_incidencias(despues_de: Optional[int] = None, limite: int = Query(100, ge=1, le=1000),
+                           serie_maquina: Optional[int] = None, desde: Optional[str] = None, hasta: Optional[str] = None,
+                           formato: str = Query("json", pattern="^(json|ndjson)$"), fresco: bool = False,
+                           fields: Optional[str] = None, db: BaseDatosFragmentada = Depends(obtener_db)):
+    # Solo se leen las columnas pedidas; el id va siempre primero porque es el cursor
+    campos = _campos_solicitados(fields, COLUMNAS_INCIDENCIA) or list(COLUMNAS_INCIDENCIA)
+    lector = partial(_leer_pagina, tabla="incidencias", columna_maquina="serie_maquina",
+                     serie_maquina=serie_maquina, desde=desde, hasta=hasta,
+                     columnas=", ".join(["id"] + [COLUMNAS_INCIDENCIA[campo] for campo in campos]))
+
+    def convertir(row):
+        return dict(zip(campos, row[1:]))
+
+    fuente, antiguedad = db.para_reportes(fresco)
+    if formato == "ndjson":
+        return StreamingResponse(_transmitir_ndjson(fuente, lector, convertir, despues_de, serie_maquina),
+                                 media_type="application/x-ndjson", headers=_cabeceras_reportes(antiguedad))
+
+    resultados = await _leer_pagina_flota(fuente, lector, despues_de, limite, serie_maquina)
+    return _respuesta_pagina([convertir(row) for row in resultados], resultados, limite,
+                             _cabeceras_reportes(antiguedad))
+
+
+# Campo de la respuesta -> columna de la tabla incidencias
+COLUMNAS_INCIDENCIA = {"id": "id", "descripcion": "descripcion", "id_maquina": "serie_maquina", "fecha": "fecha",
+                       "nombre_persona": "nombre_persona"}
 
 
 
 @app.post("/productos/")
-async def crear_producto(producto: Producto):
+async def crear_producto(producto: Producto, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.catalogo.ejecutar(_crear_producto, producto)
+    catalogo_productos.invalidar()
+    notificar_cambio(None, "producto", accion="alta", num_serie=producto.num_serie, nombre=producto.nombre, precio=producto.precio)
+    return resultado
+
+
+def _crear_producto(conexion: sqlite3.Connection, producto: Producto):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         # Verificar si el número de serie ya existe en la base de datos
@@ -527,15 +2110,18 @@ async def crear_producto(producto: Producto):
         return {"mensaje": "Producto creado correctamente"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
 
 # Eliminar producto por número de serie
 @app.delete("/productos/{num_serie}")
-async def eliminar_producto(num_serie: str):
+async def eliminar_producto(num_serie: str, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.catalogo.ejecutar(_eliminar_producto, num_serie)
+    catalogo_productos.invalidar()
+    notificar_cambio(None, "producto", accion="baja", num_serie=num_serie)
+    return resultado
+
+
+def _eliminar_producto(conexion: sqlite3.Connection, num_serie: str):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         # Verificar si el producto existe
@@ -551,15 +2137,19 @@ async def eliminar_producto(num_serie: str):
         return {"mensaje": "Producto eliminado correctamente"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
 
 # Modificar producto por número de serie
 @app.put("/productos/{num_serie}")
-async def modificar_producto(num_serie: str, nuevo_producto: Producto):
+async def modificar_producto(num_serie: str, nuevo_producto: Producto, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.catalogo.ejecutar(_modificar_producto, num_serie, nuevo_producto)
+    catalogo_productos.invalidar()
+    notificar_cambio(None, "producto", accion="modificacion", num_serie=num_serie, nuevo_num_serie=nuevo_producto.num_serie,
+                     nombre=nuevo_producto.nombre, precio=nuevo_producto.precio)
+    return resultado
+
+
+def _modificar_producto(conexion: sqlite3.Connection, num_serie: str, nuevo_producto: Producto):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         # Verificar si el producto existe
@@ -576,72 +2166,198 @@ async def modificar_producto(num_serie: str, nuevo_producto: Producto):
         return {"mensaje": "Producto modificado correctamente"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
 
 
   
 
 # Endpoint para realizar una venta
 @app.post("/venta/")
-async def realizar_venta(venta: Venta):
+async def realizar_venta(respuesta: Response, venta: Venta, idempotency_key: Optional[str] = Header(None),
+                         db: BaseDatosFragmentada = Depends(obtener_db)):
+    producto = (await catalogo_productos.vigente(db)).get(venta.num_serie)
+    resultado, repetida = await claves_idempotencia.escribir(db.para_maquina(venta.id_maquina), "/venta/", venta.id_maquina,
+                                                             idempotency_key, venta.model_dump(), _realizar_venta, venta, producto)
+    # Un reintento repetido no vuelve a invalidar ni a publicar: la venta ya se notificó
+    if repetida:
+        respuesta.headers["Idempotent-Replayed"] = "true"
+    else:
+        notificar_cambio(venta.id_maquina, "venta", num_serie=venta.num_serie, cantidad=venta.cantidad,
+                         num_slot=resultado["num_slot"], monto_total=resultado["monto_total"])
+    return resultado
+
+
+def _realizar_venta(conexion: sqlite3.Connection, venta: Venta, producto: Optional[tuple]):
     try:
-        # Verificar si la máquina existe y está encendida
-        conexion = sqlite3.connect(ruta_db)
-        cursor = conexion.cursor()
-        cursor.execute("SELECT estado FROM maquinas WHERE serial=?", (venta.id_maquina,))
-        estado_maquina = cursor.fetchone()
-        cursor.close()
-        conexion.close()
-        
-        if estado_maquina is None:
-            raise HTTPException(status_code=404, detail="La máquina no existe")
-        elif estado_maquina[0] == 'apagada':
-            raise HTTPException(status_code=400, detail="La máquina está apagada, no se puede realizar la venta")
-        
-        # Verificar si el producto existe en la máquina
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
-        cursor.execute("SELECT cantidad FROM resurtidos WHERE serie_maquina=? AND num_serie=?", 
-                       (venta.id_maquina, venta.num_serie))
-        cantidad_producto = cursor.fetchone()
-        
-        if cantidad_producto is None or cantidad_producto[0] < venta.cantidad:
-            raise HTTPException(status_code=404, detail="El producto no está disponible en la cantidad solicitada")
-        
-        # Calcular el monto total de la venta
-        cursor.execute("SELECT precio FROM productos WHERE num_serie=?", (venta.num_serie,))
-        precio_producto = cursor.fetchone()
-        
-        if precio_producto is None:
-            raise HTTPException(status_code=404, detail="El producto no existe")
-        
-        monto_total = precio_producto[0] * venta.cantidad
-        
-        # Registrar la venta
+
+        # El producto (nombre, precio) viene del catálogo en memoria; si no existe no se descuenta nada
+        if producto is None:
+            _diagnosticar_venta(cursor, venta)
+
+        # Descontar el inventario solo si la máquina no está apagada y el slot tiene existencias
+        # suficientes del producto. Sin num_slot se usa el slot de menor número que alcance.
+        # La verificación y el descuento son la misma sentencia sobre una sola fila (clave primaria),
+        # así que dos compras simultáneas no pueden vender la misma unidad.
+        cursor.execute("UPDATE inventario SET cantidad = cantidad - :cantidad "
+                       "WHERE serie_maquina = :maquina "
+                       "  AND num_slot = COALESCE(:slot, (SELECT num_slot FROM inventario INDEXED BY idx_inventario_producto "
+                       "                                    WHERE serie_maquina = :maquina AND num_serie = :producto "
+                       "                                      AND cantidad >= :cantidad ORDER BY num_slot LIMIT 1)) "
+                       "  AND num_serie = :producto AND cantidad >= :cantidad "
+                       "  AND EXISTS (SELECT 1 FROM maquinas WHERE serial = :maquina AND estado != 'apagada') "
+                       "RETURNING num_slot",
+                       {"cantidad": venta.cantidad, "maquina": venta.id_maquina, "producto": venta.num_serie,
+                        "slot": venta.num_slot})
+        descontado = cursor.fetchall()
+
+        if not descontado:
+            _diagnosticar_venta(cursor, venta)
+
+        nombre_producto, precio = producto
+        monto_total = precio * venta.cantidad
+
+        # Registrar la venta en la misma transacción
         cursor.execute("INSERT INTO ventas (serie_maquina, num_serie, nombre_producto, monto, cantidad, fecha) VALUES (?, ?, ?, ?, ?, ?)",
-                       (venta.id_maquina, venta.num_serie, venta.num_serie, monto_total, venta.cantidad, datetime.now()))
-        
-        # Restar la cantidad de productos vendidos de la máquina
-        cursor.execute("UPDATE resurtidos SET cantidad = cantidad - ? WHERE serie_maquina = ? AND num_serie = ?", 
-                       (venta.cantidad, venta.id_maquina, venta.num_serie))
+                       (venta.id_maquina, venta.num_serie, nombre_producto, monto_total, venta.cantidad, int(time.time())))
+
+        # La transacción la confirma BaseDatos.escribir, sola o agrupada con otras escrituras
+        return {"mensaje": "Venta realizada exitosamente", "monto_total": monto_total, "num_slot": descontado[0][0]}
         
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _diagnosticar_venta(cursor: sqlite3.Cursor, venta: Venta):
+    """Lanza el error adecuado cuando el descuento condicional de una venta no afectó ninguna fila."""
+    cursor.execute("SELECT estado FROM maquinas WHERE serial=?", (venta.id_maquina,))
+    estado_maquina = cursor.fetchone()
+    if estado_maquina is None:
+        raise HTTPException(status_code=404, detail="La máquina no existe")
+    elif estado_maquina[0] == 'apagada':
+        raise HTTPException(status_code=400, detail="La máquina está apagada, no se puede realizar la venta")
+
+    if venta.num_slot is not None:
+        cursor.execute("SELECT cantidad FROM inventario WHERE serie_maquina=? AND num_slot=? AND num_serie=?",
+                       (venta.id_maquina, venta.num_slot, venta.num_serie))
+        fila = cursor.fetchone()
+        if fila is None:
+            raise HTTPException(status_code=404, detail="El slot indicado no contiene este producto")
+        cantidad_producto = fila[0]
+    else:
+        cursor.execute("SELECT MAX(cantidad) FROM inventario WHERE serie_maquina=? AND num_serie=?",
+                       (venta.id_maquina, venta.num_serie))
+        cantidad_producto = cursor.fetchone()[0]
+    if cantidad_producto is None or cantidad_producto < venta.cantidad:
+        raise HTTPException(status_code=404, detail="El producto no está disponible en la cantidad solicitada")
+
+    raise HTTPException(status_code=404, detail="El producto no existe")
+
+
+MAX_VENTAS_POR_LOTE = 5000
+
+
+def _en_bloques(valores, tamano: int = 500):
+    """Divide una lista de parámetros en bloques para no exceder el límite de variables de SQLite."""
+    valores = list(valores)
+    for inicio in range(0, len(valores), tamano):
+        yield valores[inicio:inicio + tamano]
+
+
+# Endpoint para registrar en una sola transacción las ventas acumuladas sin conexión
+@app.post("/ventas/batch")
+async def realizar_ventas_lote(ventas: List[Venta], db: BaseDatosFragmentada = Depends(obtener_db)):
+    if len(ventas) > MAX_VENTAS_POR_LOTE:
+        raise HTTPException(status_code=400, detail=f"El lote no puede tener más de {MAX_VENTAS_POR_LOTE} ventas")
+    # Cada fragmento aplica sus ventas en su propia transacción; los índices se traducen a los del lote original
+    resultado = {"realizadas": 0, "rechazadas": 0, "resultados": []}
+    lote = partial(_realizar_ventas_lote, catalogo=await catalogo_productos.vigente(db))
+    for indices, parcial in zip(*await db.por_fragmento(lote, ventas, lambda venta: venta.id_maquina, con_indices=True)):
+        resultado["realizadas"] += parcial["realizadas"]
+        resultado["rechazadas"] += parcial["rechazadas"]
+        resultado["resultados"].extend(dict(fila, indice=indices[fila["indice"]]) for fila in parcial["resultados"])
+    resultado["resultados"].sort(key=lambda fila: fila["indice"])
+    for fila in resultado["resultados"]:
+        if fila["estado"] == 200:
+            venta = ventas[fila["indice"]]
+            notificar_cambio(venta.id_maquina, "venta", num_serie=venta.num_serie, cantidad=venta.cantidad,
+                             num_slot=fila["num_slot"], monto_total=fila["monto_total"])
+    return resultado
+
+
+def _realizar_ventas_lote(conexion: sqlite3.Connection, ventas: List[Venta], catalogo: dict):
+    try:
+        cursor = conexion.cursor()
+        # Tomar el bloqueo de escritura desde el inicio: el lote lee existencias y luego las descuenta
+        cursor.execute("BEGIN IMMEDIATE")
+
+        maquinas = {}
+        for bloque in _en_bloques({venta.id_maquina for venta in ventas}):
+            cursor.execute(f"SELECT serial, estado FROM maquinas WHERE serial IN ({','.join('?' * len(bloque))})", bloque)
+            maquinas.update(cursor.fetchall())
+
+        # Existencias por (máquina, producto), en el mismo orden de slots que la venta individual
+        existencias = {}
+        for bloque in _en_bloques(maquinas):
+            cursor.execute(f"SELECT serie_maquina, num_slot, num_serie, cantidad FROM inventario "
+                           f"WHERE serie_maquina IN ({','.join('?' * len(bloque))}) ORDER BY serie_maquina, num_slot", bloque)
+            for serie_maquina, num_slot, num_serie, cantidad in cursor.fetchall():
+                existencias.setdefault((serie_maquina, num_serie), []).append([num_slot, cantidad])
+
+        fecha = int(time.time())
+        resultados = []
+        filas_ventas = []
+        descuentos = {}
+        for indice, venta in enumerate(ventas):
+            if venta.cantidad <= 0:
+                resultados.append({"indice": indice, "estado": 422, "detalle": "La cantidad vendida debe ser mayor que cero"})
+                continue
+            estado_maquina = maquinas.get(venta.id_maquina)
+            if estado_maquina is None:
+                resultados.append({"indice": indice, "estado": 404, "detalle": "La máquina no existe"})
+                continue
+            if estado_maquina == 'apagada':
+                resultados.append({"indice": indice, "estado": 400, "detalle": "La máquina está apagada, no se puede realizar la venta"})
+                continue
+
+            registro = next((r for r in existencias.get((venta.id_maquina, venta.num_serie), ())
+                             if r[1] >= venta.cantidad and venta.num_slot in (None, r[0])), None)
+            if registro is None:
+                resultados.append({"indice": indice, "estado": 404, "detalle": "El producto no está disponible en la cantidad solicitada"})
+                continue
+            if venta.num_serie not in catalogo:
+                resultados.append({"indice": indice, "estado": 404, "detalle": "El producto no existe"})
+                continue
+
+            nombre_producto, precio = catalogo[venta.num_serie]
+            monto_total = precio * venta.cantidad
+            registro[1] -= venta.cantidad
+            slot = (venta.id_maquina, registro[0])
+            descuentos[slot] = descuentos.get(slot, 0) + venta.cantidad
+            filas_ventas.append((venta.id_maquina, venta.num_serie, nombre_producto, monto_total, venta.cantidad, fecha))
+            resultados.append({"indice": indice, "estado": 200, "monto_total": monto_total, "num_slot": registro[0]})
+
+        # Aplicar todo el lote con inserciones y descuentos agregados
+        cursor.executemany("INSERT INTO ventas (serie_maquina, num_serie, nombre_producto, monto, cantidad, fecha) VALUES (?, ?, ?, ?, ?, ?)",
+                           filas_ventas)
+        cursor.executemany("UPDATE inventario SET cantidad = cantidad - ? WHERE serie_maquina = ? AND num_slot = ?",
+                           [(cantidad, serie_maquina, num_slot) for (serie_maquina, num_slot), cantidad in descuentos.items()])
         conexion.commit()
-        cursor.close()
-        conexion.close()
-        
-        return {"mensaje": "Venta realizada exitosamente", "monto_total": monto_total}
-        
+
+        return {"realizadas": len(filas_ventas), "rechazadas": len(ventas) - len(filas_ventas), "resultados": resultados}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # Endpoint para la solicitud de relleno
 @app.post("/solicitud-relleno-por-maquina/")
-async def solicitud_relleno_por_Maquina(num_serie_maquina: int, productos_restantes: int, fecha: str, hora: str):
+async def solicitud_relleno_por_Maquina(num_serie_maquina: int, productos_restantes: int, fecha: str, hora: str, db: BaseDatosFragmentada = Depends(obtener_db)):
+    resultado = await db.para_maquina(num_serie_maquina).escribir(_solicitud_relleno_por_Maquina, num_serie_maquina, productos_restantes, fecha, hora)
+    notificar_cambio(num_serie_maquina, "relleno", productos_restantes=productos_restantes, fecha=fecha, hora=hora)
+    return resultado
+
+
+def _solicitud_relleno_por_Maquina(conexion: sqlite3.Connection, num_serie_maquina: int, productos_restantes: int, fecha: str, hora: str):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         if productos_restantes < 0 or productos_restantes > 100:
@@ -650,47 +2366,53 @@ async def solicitud_relleno_por_Maquina(num_serie_maquina: int, productos_restan
         porcentaje_restante = (productos_restantes / 100) * 100
 
         # Registrar la solicitud de relleno
-        cursor.execute("INSERT INTO solicitudes_relleno (num_serie_maquina, productos_restantes, fecha, hora) VALUES (?, ?, ?, ?)",
-                       (num_serie_maquina, productos_restantes, fecha, hora))
-        conexion.commit()
+        cursor.execute("INSERT INTO solicitudes_relleno (id, num_serie_maquina, productos_restantes, fecha, hora) VALUES (?, ?, ?, ?, ?)",
+                       (_siguiente_id(conexion, "solicitudes_relleno"), num_serie_maquina, productos_restantes, fecha, hora))
         
         return {"mensaje": "Solicitud de relleno registrada correctamente"}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cursor.close()
-        conexion.close()
 
 @app.get("/obtener-solicitud-relleno-por-maquina/")
-async def obtener_solicitud_relleno_por_maquina():
-    try:
-        conexion = sqlite3.connect(ruta_db)
-        cursor = conexion.cursor()
-        cursor.execute("SELECT * FROM solicitudes_relleno")
-        resultados = cursor.fetchall()
-        cursor.close()
-        conexion.close()
+async def obtener_solicitud_relleno_por_maquina(despues_de: Optional[int] = None, limite: int = Query(100, ge=1, le=1000),
+                                                serie_maquina: Optional[int] = None, desde: Optional[str] = None,
+                                                hasta: Optional[str] = None,
+                                                formato: str = Query("json", pattern="^(json|ndjson)$"),
+                                                fresco: bool = False, db: BaseDatosFragmentada = Depends(obtener_db)):
+    lector = partial(_leer_pagina, tabla="solicitudes_relleno", columna_maquina="num_serie_maquina",
+                     serie_maquina=serie_maquina, desde=desde, hasta=hasta)
+    fuente, antiguedad = db.para_reportes(fresco)
+    if formato == "ndjson":
+        return StreamingResponse(_transmitir_ndjson(fuente, lector, _solicitud_relleno_a_dict, despues_de, serie_maquina),
+                                 media_type="application/x-ndjson", headers=_cabeceras_reportes(antiguedad))
 
-        if resultados:
-            return [{"id_informe": row[0], "num_serie_maquina": row[2], "productos_restantes": row[3], "fecha": row[4], "hora": row[5]} for row in resultados]
-        else:
-            raise HTTPException(status_code=404, detail="No se encontraron solicitudes de relleno.")
-    except sqlite3.Error as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    resultados = await _leer_pagina_flota(fuente, lector, despues_de, limite, serie_maquina)
+    if not resultados and despues_de is None:
+        raise HTTPException(status_code=404, detail="No se encontraron solicitudes de relleno.")
+    return _respuesta_pagina([_solicitud_relleno_a_dict(row) for row in resultados], resultados, limite,
+                             _cabeceras_reportes(antiguedad))
+
+
+def _solicitud_relleno_a_dict(row):
+    return {"id_informe": row[0], "num_serie_maquina": row[2], "productos_restantes": row[3], "fecha": row[4], "hora": row[5]}
 
 
     
 @app.get("/verificar-relleno-por-producto/{num_serie}")
-async def verficar_relleno_por_producto(num_serie: int, serial_maquina: int):
+async def verficar_relleno_por_producto(num_serie: int, serial_maquina: int, db: BaseDatosFragmentada = Depends(obtener_db)):
+    return await db.para_maquina(serial_maquina).ejecutar(_verficar_relleno_por_producto, num_serie, serial_maquina)
+
+
+def _verficar_relleno_por_producto(conexion: sqlite3.Connection, num_serie: int, serial_maquina: int):
     try:
-        conexion = sqlite3.connect(ruta_db)
         cursor = conexion.cursor()
 
         # Verificar si el producto existe en el inventario de la máquina
-        cursor.execute("SELECT cantidad FROM resurtidos WHERE serie_maquina=? AND num_serie=?", (serial_maquina, num_serie))
+        # Existencias del producto sumando todos los slots que lo contienen
+        cursor.execute("SELECT SUM(cantidad) FROM inventario WHERE serie_maquina=? AND num_serie=?", (serial_maquina, num_serie))
         cantidad_producto = cursor.fetchone()
         
-        if not cantidad_producto:
+        if cantidad_producto[0] is None:
             raise HTTPException(status_code=404, detail="No hay prodcutos disponibles en la maquina,se necesita urgentemente relleno del producto")
 
         cantidad_actual = cantidad_producto[0]
@@ -700,14 +2422,643 @@ async def verficar_relleno_por_producto(num_serie: int, serial_maquina: int):
         if cantidad_actual <= 10:
             mensaje = "Se necesita relleno para el producto"
 
-        cursor.close()
-        conexion.close()
 
         return {"num_serie": num_serie, "cantidad_actual": cantidad_actual, "mensaje": mensaje}
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Endpoint para revisar en una sola consulta qué slots de toda la flota necesitan relleno
+# Con "porcentaje" el umbral es relativo a la capacidad máxima del slot; si no, se usa "umbral" en unidades
+@app.get("/verificar-relleno-flota/")
+async def verificar_relleno_flota(umbral: int = Query(10, ge=0), porcentaje: Optional[float] = Query(None, ge=0, le=100),
+                                  db: BaseDatosFragmentada = Depends(obtener_db)):
+    slots = [slot for parcial in await db.en_todos(_verificar_relleno_flota, umbral, porcentaje) for slot in parcial["slots"]]
+    slots.sort(key=lambda slot: (slot["serial_maquina"], slot["num_slot"]))
+    catalogo = await catalogo_productos.vigente(db)
+    for slot in slots:
+        slot["nombre"] = catalogo.get(slot["num_serie"], (None,))[0]
+    return {"total": len(slots), "slots": slots}
+
+
+def _verificar_relleno_flota(conexion: sqlite3.Connection, umbral: int, porcentaje: Optional[float]):
+    try:
+        cursor = conexion.cursor()
+        # INDEXED BY garantiza que solo se recorran las filas con existencias bajas; el orden por
+        # máquina y slot lo da el endpoint al juntar los fragmentos, sin ordenar aquí en una tabla temporal
+        if porcentaje is None:
+            cursor.execute("SELECT r.serie_maquina, r.num_slot, r.num_serie, r.cantidad, s.capacidad_maxima "
+                           "FROM inventario r INDEXED BY idx_inventario_cantidad "
+                           "LEFT JOIN slots s ON s.serial_maquina = r.serie_maquina AND s.num_slot = r.num_slot "
+                           "WHERE r.cantidad <= ?", (umbral,))
+        else:
+            # La primera condición acota el recorrido del índice de cantidad con la mayor capacidad de la flota
+            cursor.execute("SELECT r.serie_maquina, r.num_slot, r.num_serie, r.cantidad, s.capacidad_maxima "
+                           "FROM inventario r INDEXED BY idx_inventario_cantidad "
+                           "JOIN slots s ON s.serial_maquina = r.serie_maquina AND s.num_slot = r.num_slot "
+                           "WHERE r.cantidad <= (SELECT MAX(capacidad_maxima) FROM slots) * :porcentaje / 100.0 "
+                           "  AND r.cantidad <= s.capacidad_maxima * :porcentaje / 100.0", {"porcentaje": porcentaje})
+
+        # El nombre del producto se completa con el catálogo en memoria
+        slots = [{"serial_maquina": row[0], "num_slot": row[1], "num_serie": row[2], "nombre": None,
+                  "cantidad_actual": row[3], "capacidad_maxima": row[4]} for row in cursor.fetchall()]
+        return {"total": len(slots), "slots": slots}
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Verificación de consistencia del inventario vigente
+CONSULTAS_CONSISTENCIA = {
+    "sin_maquina": "FROM inventario i LEFT JOIN maquinas m ON m.serial = i.serie_maquina WHERE m.serial IS NULL",
+    "sin_slot": "FROM inventario i LEFT JOIN slots s ON s.serial_maquina = i.serie_maquina AND s.num_slot = i.num_slot "
+                "WHERE s.id IS NULL",
+    "sobre_capacidad": "FROM inventario i JOIN slots s ON s.serial_maquina = i.serie_maquina AND s.num_slot = i.num_slot "
+                       "WHERE i.cantidad > s.capacidad_maxima",
+    "producto_inexistente": "FROM inventario i LEFT JOIN productos p ON p.num_serie = i.num_serie WHERE p.num_serie IS NULL",
+}
+MUESTRA_CONSISTENCIA = 100
+
+
+@app.get("/inventario/consistencia/")
+async def verificar_consistencia_inventario(db: BaseDatosFragmentada = Depends(obtener_db)):
+    hallazgos = {nombre: {"total": 0, "slots": []} for nombre in CONSULTAS_CONSISTENCIA}
+    for parcial in await db.en_todos(_verificar_consistencia_inventario):
+        for nombre, (total, slots) in parcial.items():
+            hallazgos[nombre]["total"] += total
+            hallazgos[nombre]["slots"].extend(slots)
+    for hallazgo in hallazgos.values():
+        hallazgo["slots"] = sorted(hallazgo["slots"], key=lambda slot: (slot["serial_maquina"], slot["num_slot"]))[:MUESTRA_CONSISTENCIA]
+    return {"consistente": all(hallazgo["total"] == 0 for hallazgo in hallazgos.values()), "hallazgos": hallazgos}
+
+
+def _verificar_consistencia_inventario(conexion: sqlite3.Connection):
+    """Para cada comprobación, el número de slots que la incumplen y una muestra de ellos."""
+    try:
+        cursor = conexion.cursor()
+        resultado = {}
+        for nombre, condicion in CONSULTAS_CONSISTENCIA.items():
+            total = cursor.execute(f"SELECT COUNT(*) {condicion}").fetchone()[0]
+            cursor.execute(f"SELECT i.serie_maquina, i.num_slot, i.num_serie, i.cantidad {condicion} "
+                           f"ORDER BY i.serie_maquina, i.num_slot LIMIT ?", (MUESTRA_CONSISTENCIA,))
+            resultado[nombre] = (total, [{"serial_maquina": row[0], "num_slot": row[1], "num_serie": row[2], "cantidad": row[3]}
+                                         for row in cursor.fetchall()])
+        return resultado
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Pronóstico de agotamiento para toda la flota a partir del historial de ventas
+VIDA_MEDIA_PRONOSTICO_DIAS = float(os.environ.get("MAQUINAS_PRONOSTICO_VIDA_MEDIA_DIAS", "14"))
+HISTORIA_PRONOSTICO_DIAS = int(os.environ.get("MAQUINAS_PRONOSTICO_HISTORIA_DIAS", "365"))
+TAMANO_BLOQUE_PRONOSTICO = 200_000
+
+
+class PronosticoAgotamiento:
+    """Velocidad de venta de cada (máquina, producto) de la flota, con refresco incremental.
+
+    La velocidad es un promedio con decaimiento exponencial de las unidades vendidas por día:
+    por cada par se guarda la suma de sus ventas ponderadas por exp(-(referencia - fecha) / tau),
+    que para un ritmo constante de r unidades por día vale r * tau. Cada refresco lee solo las
+    ventas con id mayor que el último visto en cada fragmento y reescala las sumas a la nueva
+    referencia.
+    """
+
+    def __init__(self, vida_media: float = VIDA_MEDIA_PRONOSTICO_DIAS, historia: int = HISTORIA_PRONOSTICO_DIAS):
+        self.vida_media = vida_media
+        self.tau = vida_media / math.log(2)  # En días
+        self.historia = historia
+        self.referencia = None
+        # Por fragmento: (último id de venta leído, series, productos, sumas), ordenados por (serie, producto)
+        self._fragmentos = {}
+        self._candado = asyncio.Lock()
+
+    async def actualizar(self, fuente: ConjuntoFragmentos):
+        async with self._candado:
+            referencia = time.time()
+            desde = int(referencia - self.historia * 86400)
+            parciales = await asyncio.gather(*(
+                fragmento.ejecutar(_acumular_ventas, self._fragmentos.get(indice, (0,))[0], desde, referencia, self.tau)
+                for indice, fragmento in enumerate(fuente.fragmentos)))
+            decaimiento = 1.0 if self.referencia is None else math.exp((self.referencia - referencia) / (self.tau * 86400))
+            for indice, (ultimo_id, series, productos, sumas) in enumerate(parciales):
+                anterior = self._fragmentos.get(indice)
+                if anterior is not None:
+                    series, productos, sumas = _sumar_por_par(np.concatenate((anterior[1], series)),
+                                                              np.concatenate((anterior[2], productos)),
+                                                              np.concatenate((anterior[3] * decaimiento, sumas)))
+                    # Una instantánea de reportes puede ir por detrás de lo ya leído en vivo
+                    ultimo_id = max(ultimo_id, anterior[0])
+                self._fragmentos[indice] = (ultimo_id, series, productos, sumas)
+            self.referencia = referencia
+
+    def priorizar(self, existencias: list, limite: int, horizonte: Optional[float]) -> tuple:
+        """Pares con ventas ordenados por días hasta agotarse (y a igualdad, por velocidad) y su total."""
+        decaimiento = math.exp((self.referencia - time.time()) / (self.tau * 86400))
+        columnas = []
+        for indice, (series, productos, cantidades) in enumerate(existencias):
+            velocidades = np.zeros(len(series))
+            _, series_ventas, productos_ventas, sumas = self._fragmentos.get(indice, (0, [], [], []))
+            if len(series) and len(series_ventas):
+                # Misma clave entera para ambos lados: serie * nº de productos + posición del producto
+                conocidos = np.union1d(productos_ventas, productos)
+                claves_ventas = series_ventas * len(conocidos) + np.searchsorted(conocidos, productos_ventas)
+                claves = series * len(conocidos) + np.searchsorted(conocidos, productos)
+                posiciones = np.minimum(np.searchsorted(claves_ventas, claves), len(claves_ventas) - 1)
+                encontrados = claves_ventas[posiciones] == claves
+                velocidades[encontrados] = sumas[posiciones[encontrados]] * decaimiento / self.tau
+            columnas.append((series, productos, cantidades, velocidades))
+        series, productos, cantidades, velocidades = (np.concatenate(columna) for columna in zip(*columnas))
+
+        con_ventas = velocidades > 0
+        series, productos, cantidades, velocidades = (series[con_ventas], productos[con_ventas],
+                                                      cantidades[con_ventas], velocidades[con_ventas])
+        dias = cantidades / velocidades
+        if horizonte is not None:
+            dentro = dias <= horizonte
+            series, productos, cantidades, velocidades, dias = (series[dentro], productos[dentro], cantidades[dentro],
+                                                                velocidades[dentro], dias[dentro])
+        orden = np.lexsort((-velocidades, dias))[:limite]
+        return len(dias), [{"serial_maquina": int(series[i]), "num_serie": int(productos[i]), "nombre": None,
+                            "existencias": int(cantidades[i]), "velocidad_diaria": round(float(velocidades[i]), 3),
+                            "dias_para_agotarse": round(float(dias[i]), 2)} for i in orden]
+
+
+def _sumar_por_par(series, productos, valores) -> tuple:
+    """Suma `valores` por (serie, producto); devuelve los pares sin repetir, ordenados, y sus sumas."""
+    if len(series) == 0:
+        return series, productos, valores
+    conocidos = np.unique(productos)
+    claves, inversos = np.unique(series * len(conocidos) + np.searchsorted(conocidos, productos), return_inverse=True)
+    return claves // len(conocidos), conocidos[claves % len(conocidos)], np.bincount(inversos, weights=valores)
+
+
+def _acumular_ventas(conexion: sqlite3.Connection, despues_de: int, desde: int, referencia: float, tau: float) -> tuple:
+    """Ventas con id mayor que `despues_de`, ponderadas con el decaimiento y sumadas por (máquina, producto)."""
+    try:
+        # Los ids se asignan al escribir y hay un solo escritor: todo id hasta el máximo ya está confirmado
+        hasta = max(despues_de, conexion.execute("SELECT MAX(id) FROM ventas").fetchone()[0] or 0)
+        # Se leen filas sueltas: agrupar en SQL por día apenas reduce filas y obliga a ordenarlas todas
+        cursor = conexion.execute("SELECT serie_maquina, num_serie, cantidad, fecha FROM ventas "
+                                  "WHERE id > ? AND id <= ? AND fecha >= ? AND cantidad > 0 AND num_serie IS NOT NULL",
+                                  (despues_de, hasta, desde))
+        bloques = [(np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0))]
+        while filas := cursor.fetchmany(TAMANO_BLOQUE_PRONOSTICO):
+            bloque = np.array(filas, dtype=np.int64)
+            bloques.append(_sumar_por_par(bloque[:, 0], bloque[:, 1],
+                                          bloque[:, 2] * np.exp((bloque[:, 3] - referencia) / (tau * 86400))))
+        series, productos, sumas = (np.concatenate(columna) for columna in zip(*bloques))
+        return (hasta,) + _sumar_por_par(series, productos, sumas)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _leer_existencias(conexion: sqlite3.Connection) -> tuple:
+    """Existencias vigentes por (máquina, producto) como tres columnas de NumPy."""
+    try:
+        filas = conexion.execute("SELECT serie_maquina, num_serie, SUM(cantidad) FROM inventario "
+                                 "GROUP BY serie_maquina, num_serie").fetchall()
+        datos = np.array(filas, dtype=np.int64).reshape(-1, 3)
+        return datos[:, 0], datos[:, 1], datos[:, 2]
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+pronostico_agotamiento = PronosticoAgotamiento()
+
+
+@app.get("/pronostico-relleno/")
+async def pronostico_relleno(respuesta: Response, limite: int = Query(100, ge=1, le=1000),
+                             horizonte_dias: Optional[float] = Query(None, ge=0), fresco: bool = False,
+                             db: BaseDatosFragmentada = Depends(obtener_db)):
+    if np is None:
+        raise HTTPException(status_code=503, detail="El pronóstico de agotamiento requiere NumPy, que no está instalado")
+    fuente, antiguedad = db.para_reportes(fresco)
+    respuesta.headers.update(_cabeceras_reportes(antiguedad))
+    await pronostico_agotamiento.actualizar(fuente)
+    existencias = await fuente.en_todos(_leer_existencias)
+    total, prioridades = pronostico_agotamiento.priorizar(existencias, limite, horizonte_dias)
+    catalogo = await catalogo_productos.vigente(db)
+    for prioridad in prioridades:
+        prioridad["nombre"] = catalogo.get(prioridad["num_serie"], (None,))[0]
+    return {"vida_media_dias": pronostico_agotamiento.vida_media, "total": total, "prioridades": prioridades}
+
+# Análisis de ventas en un rango de fechas, agrupadas por hora, día o mes (hora local)
+FORMATOS_AGRUPACION = {"hora": "%Y-%m-%d %H:00", "dia": "%Y-%m-%d", "mes": "%Y-%m"}
+
+
+@app.get("/ventas/rango/")
+async def ventas_por_rango(respuesta: Response, desde: datetime, hasta: datetime, serie_maquina: Optional[int] = None,
+                           num_serie: Optional[int] = None, agrupar: str = Query("dia", pattern="^(hora|dia|mes)$"),
+                           fresco: bool = False, db: BaseDatosFragmentada = Depends(obtener_db)):
+    if hasta <= desde:
+        raise HTTPException(status_code=400, detail="La fecha final debe ser posterior a la inicial")
+    fuente, antiguedad = db.para_reportes(fresco)
+    respuesta.headers.update(_cabeceras_reportes(antiguedad))
+    if serie_maquina is not None:
+        return await fuente.para_maquina(serie_maquina).ejecutar(_ventas_por_rango, desde, hasta, serie_maquina, num_serie, agrupar)
+
+    # Sin máquina concreta, los periodos de cada fragmento se suman
+    periodos = {}
+    for parcial in await fuente.en_todos(_ventas_por_rango, desde, hasta, serie_maquina, num_serie, agrupar):
+        for fila in parcial["periodos"]:
+            acumulado = periodos.setdefault(fila["periodo"], {"periodo": fila["periodo"], "monto_total": 0,
+                                                              "unidades": 0, "num_ventas": 0})
+            for clave in ("monto_total", "unidades", "num_ventas"):
+                acumulado[clave] += fila[clave]
+    return {"desde": desde, "hasta": hasta, "agrupar": agrupar, "periodos": [periodos[clave] for clave in sorted(periodos)]}
+
+
+def _periodos_locales(desde: datetime, hasta: datetime, agrupar: str):
+    """(etiqueta, inicio, fin) de cada hora, día o mes en hora local que toca [desde, hasta), en época Unix.
+
+    Las etiquetas coinciden con strftime(..., 'unixepoch', 'localtime') de SQLite.
+    """
+    inicio_rango, fin_rango = int(desde.timestamp()), int(hasta.timestamp())
+    actual = datetime.fromtimestamp(inicio_rango).replace(minute=0, second=0, microsecond=0)
+    if agrupar != "hora":
+        actual = actual.replace(hour=0)
+    if agrupar == "mes":
+        actual = actual.replace(day=1)
+    while True:
+        if agrupar == "hora":
+            siguiente = actual + timedelta(hours=1)
+        elif agrupar == "dia":
+            siguiente = actual + timedelta(days=1)
+        else:
+            siguiente = actual.replace(year=actual.year + actual.month // 12, month=actual.month % 12 + 1)
+        inicio, fin = max(inicio_rango, int(actual.timestamp())), min(fin_rango, int(siguiente.timestamp()))
+        if inicio < fin:
+            yield actual.strftime(FORMATOS_AGRUPACION[agrupar]), inicio, fin
+        if fin >= fin_rango:
+            return
+        actual = siguiente
+
+
+def _ventas_por_rango(conexion: sqlite3.Connection, desde: datetime, hasta: datetime, serie_maquina: Optional[int],
+                      num_serie: Optional[int], agrupar: str):
+    try:
+        # Cada periodo es un rango de los índices sobre (serie_maquina, num_serie, fecha), (serie_maquina, fecha),
+        # (num_serie, fecha) o (fecha); agrupar por la fecha formateada obligaría a ordenar todas las ventas
+        condiciones, filtros = ["fecha >= ?", "fecha < ?"], []
+        if serie_maquina is not None:
+            condiciones.append("serie_maquina = ?")
+            filtros.append(serie_maquina)
+        if num_serie is not None:
+            condiciones.append("num_serie = ?")
+            filtros.append(num_serie)
+        consulta = f"SELECT SUM(monto), SUM(cantidad), COUNT(*) FROM ventas WHERE {' AND '.join(condiciones)}"
+
+        cursor = conexion.cursor()
+        periodos = []
+        for periodo, inicio, fin in _periodos_locales(desde, hasta, agrupar):
+            monto, unidades, num_ventas = cursor.execute(consulta, [inicio, fin] + filtros).fetchone()
+            if num_ventas:
+                periodos.append({"periodo": periodo, "monto_total": monto, "unidades": unidades, "num_ventas": num_ventas})
+        return {"desde": desde, "hasta": hasta, "agrupar": agrupar, "periodos": periodos}
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Exportación masiva en CSV o NDJSON, leída por páginas para usar memoria constante
+TAMANO_PAGINA_EXPORTACION = 5000
+
+# tabla: (columna de la máquina, columnas exportadas); ventas.fecha se exporta en hora local legible
+TABLAS_EXPORTABLES = {
+    "ventas": ("serie_maquina", ["id", "serie_maquina", "num_serie", "nombre_producto", "monto", "cantidad",
+                                 "strftime('%Y-%m-%d %H:%M:%S', fecha, 'unixepoch', 'localtime') AS fecha"]),
+    "resurtidos": ("serie_maquina", ["id", "serie_maquina", "num_serie", "cantidad", "fecha", "num_slot"]),
+    "incidencias": ("serie_maquina", ["id", "descripcion", "serie_maquina", "fecha", "nombre_persona"]),
+}
+
+
+@app.get("/exportar/{tabla}")
+async def exportar_tabla(tabla: str, formato: str = Query("csv", pattern="^(csv|ndjson)$"), gzip: bool = False,
+                         serie_maquina: Optional[int] = None, desde: Optional[datetime] = None,
+                         hasta: Optional[datetime] = None, fresco: bool = False,
+                         db: BaseDatosFragmentada = Depends(obtener_db)):
+    if tabla not in TABLAS_EXPORTABLES:
+        raise HTTPException(status_code=404, detail=f"Solo se pueden exportar: {', '.join(TABLAS_EXPORTABLES)}")
+    columna_maquina, columnas = TABLAS_EXPORTABLES[tabla]
+
+    # ventas guarda la fecha como época Unix; las demás tablas como texto "AAAA-MM-DD HH:MM:SS"
+    def limite_fecha(fecha: Optional[datetime]):
+        if fecha is None:
+            return None
+        return int(fecha.timestamp()) if tabla == "ventas" else fecha.isoformat(sep=" ")
+
+    lector = partial(_leer_pagina, tabla=tabla, columna_maquina=columna_maquina, serie_maquina=serie_maquina,
+                     desde=limite_fecha(desde), hasta=limite_fecha(hasta), columnas=", ".join(columnas))
+    nombres = [columna.rsplit(" AS ", 1)[-1] for columna in columnas]
+    fuente, antiguedad = db.para_reportes(fresco)
+
+    nombre_archivo = f"{tabla}.{formato}" + (".gz" if gzip else "")
+    headers = dict(_cabeceras_reportes(antiguedad), **{"Content-Disposition": f'attachment; filename="{nombre_archivo}"'})
+    media_type = "application/gzip" if gzip else ("text/csv; charset=utf-8" if formato == "csv" else "application/x-ndjson")
+    return StreamingResponse(_transmitir_exportacion(fuente, lector, serie_maquina, nombres, formato, gzip),
+                             media_type=media_type, headers=headers)
+
+
+async def _transmitir_exportacion(db: ConjuntoFragmentos, lector, serie_maquina: Optional[int], nombres: list,
+                                  formato: str, comprimir: bool):
+    """Emite la tabla completa página a página; cada página es una lectura corta e independiente."""
+    compresor = zlib.compressobj(wbits=31) if comprimir else None  # wbits=31: formato gzip
+
+    def codificar(texto: str) -> bytes:
+        datos = texto.encode("utf-8")
+        return compresor.compress(datos) if compresor else datos
+
+    def a_texto(filas) -> str:
+        if formato == "ndjson":
+            return "".join(_linea_json(dict(zip(nombres, fila))) + "\n" for fila in filas)
+        salida = io.StringIO()
+        csv.writer(salida, lineterminator="\n").writerows(filas)
+        return salida.getvalue()
+
+    if formato == "csv":
+        yield codificar(a_texto([nombres]))
+    # Los ids de ventas y resurtidos se repiten entre fragmentos, así que se exporta un fragmento tras otro
+    for fragmento in (db.fragmentos if serie_maquina is None else [db.para_maquina(serie_maquina)]):
+        despues_de = None
+        while True:
+            filas = await fragmento.ejecutar(lector, despues_de, TAMANO_PAGINA_EXPORTACION)
+            if filas:
+                datos = codificar(a_texto(filas))
+                if datos:
+                    yield datos
+            if len(filas) < TAMANO_PAGINA_EXPORTACION:
+                break
+            despues_de = filas[-1][0]
+    if compresor:
+        yield compresor.flush()
+
+
+# Flujo de cambios para los paneles (server-sent events), en lugar de consultar el estado periódicamente
+MAX_MENSAJES_POR_ENVIO = 100
+
+
+@app.get("/eventos/")
+async def flujo_eventos(serial: Optional[List[int]] = Query(None), ubicacion: Optional[List[str]] = Query(None),
+                        db: BaseDatosFragmentada = Depends(obtener_db)):
+    """Emite los cambios de la flota a medida que se escriben, filtrados por máquina o por ubicación.
+
+    Con varios filtros llega lo que cumpla cualquiera de ellos; sin filtros, todo. Los cambios
+    del catálogo llegan siempre. Un cliente que no lee a tiempo recibe "descartado" y se cierra
+    su flujo; EventSource vuelve a conectarse solo.
+    """
+    seriales = set(serial or ()) if serial or ubicacion else None
+    # Se suscribe antes de resolver las ubicaciones para no perder las altas que ocurran mientras tanto
+    suscriptor = canal_eventos.suscribir(seriales, set(ubicacion or ()))
+    if ubicacion:
+        try:
+            for parcial in await db.en_todos(_seriales_por_ubicacion, ubicacion):
+                seriales.update(parcial)
+        except Exception:
+            canal_eventos.cancelar(suscriptor)
+            raise
+    return StreamingResponse(_transmitir_eventos(suscriptor), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def _transmitir_eventos(suscriptor: Suscriptor):
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                mensaje = await asyncio.wait_for(suscriptor.cola.get(), INTERVALO_LATIDO_SSE)
+            except asyncio.TimeoutError:
+                # Comentario SSE: mantiene abiertos los proxies y detecta clientes que ya no están
+                yield ": latido\n\n"
+                continue
+            # Lo que ya esté en cola se envía en el mismo bloque
+            mensajes = [mensaje]
+            while mensajes[-1] is not None and len(mensajes) < MAX_MENSAJES_POR_ENVIO and not suscriptor.cola.empty():
+                mensajes.append(suscriptor.cola.get_nowait())
+            if mensajes[-1] is None:
+                yield "".join(mensajes[:-1]) + "event: descartado\ndata: {}\n\n"
+                return
+            yield "".join(mensajes)
+    finally:
+        canal_eventos.cancelar(suscriptor)
+
+
+def _seriales_por_ubicacion(conexion: sqlite3.Connection, ubicaciones: list) -> list:
+    try:
+        cursor = conexion.execute(f"SELECT serial FROM maquinas WHERE ubicacion IN ({','.join('?' * len(ubicaciones))})",
+                                  ubicaciones)
+        return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Canal de telemetría por WebSocket: cada máquina mantiene una conexión y envía sus eventos por ella
+TELEMETRIA_LOTE_MS = float(os.environ.get("MAQUINAS_WS_LOTE_MS", "10"))
+TELEMETRIA_LOTE_MAX = int(os.environ.get("MAQUINAS_WS_LOTE_MAX", "200"))
+TELEMETRIA_PENDIENTES_MAX = 1000  # Eventos recibidos y aún sin aplicar por conexión; al llenarse se deja de leer
+TIPOS_TELEMETRIA = ("venta", "latido", "estado", "relleno", "incidencia")
+
+
+class EventoTelemetria(BaseModel):
+    id: int
+    tipo: str
+    # venta
+    num_serie: Optional[int] = None
+    cantidad: int = Field(1, ge=1)
+    num_slot: Optional[int] = None
+    # estado
+    estado: Optional[str] = None
+    # relleno
+    productos_restantes: Optional[int] = None
+    fecha: Optional[str] = None
+    hora: Optional[str] = None
+    # incidencia
+    descripcion: Optional[str] = None
+    nombre_persona: Optional[str] = None
+
+
+# Máquinas con canal abierto en este proceso: serial -> datos de la conexión
+maquinas_conectadas = {}
+
+
+@app.get("/telemetria/conexiones/")
+async def listar_conexiones_telemetria():
+    ahora = time.time()
+    maquinas = [{"serial": serial, "conectada_desde": datetime.fromtimestamp(conexion["conectada_desde"]).isoformat(timespec="seconds"),
+                 "segundos_sin_contacto": round(ahora - conexion["ultimo_contacto"], 3), "eventos": conexion["eventos"]}
+                for serial, conexion in sorted(maquinas_conectadas.items())]
+    return {"total": len(maquinas), "maquinas": maquinas}
+
+
+@app.websocket("/ws/maquinas/{serial}")
+async def telemetria_maquina(websocket: WebSocket, serial: int, db: BaseDatosFragmentada = Depends(obtener_db)):
+    """Recibe eventos JSON {"id", "tipo", ...} y responde a cada lote con {"tipo": "ack", "resultados": [...]}.
+
+    Los eventos que llegan juntos se aplican en una sola transacción (cada uno en su SAVEPOINT)
+    y el acuse se envía una vez confirmada. Un evento sin acuse puede haberse aplicado o no.
+    """
+    await websocket.accept()
+    if not await db.para_maquina(serial).ejecutar(_maquina_existe, serial):
+        await websocket.close(code=4404, reason="La máquina no existe")
+        return
+
+    conexion = {"conectada_desde": time.time(), "ultimo_contacto": time.time(), "eventos": 0}
+    maquinas_conectadas[serial] = conexion
+    pendientes = asyncio.Queue(TELEMETRIA_PENDIENTES_MAX)
+    lector = asyncio.create_task(_recibir_telemetria(websocket, pendientes))
+    try:
+        while (lote := await _siguiente_lote_telemetria(pendientes)) is not None:
+            conexion["ultimo_contacto"] = time.time()
+            conexion["eventos"] += len(lote)
+            resultados = await _aplicar_telemetria(db, serial, lote)
+            await websocket.send_text(_linea_json({"tipo": "ack", "resultados": resultados}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        lector.cancel()
+        if maquinas_conectadas.get(serial) is conexion:
+            del maquinas_conectadas[serial]
+
+
+async def _recibir_telemetria(websocket: WebSocket, pendientes: asyncio.Queue):
+    """Encola los mensajes recibidos; None al cerrarse la conexión."""
+    try:
+        while True:
+            mensaje = await websocket.receive()
+            if mensaje["type"] == "websocket.disconnect":
+                break
+            await pendientes.put(mensaje.get("text") or mensaje.get("bytes") or "")
+    finally:
+        # Sin esperar: el consumidor puede haber terminado o estar cancelado. Con la cola llena se
+        # descarta el mensaje más antiguo, cuyo acuse ya no llegaría al cliente.
+        if pendientes.full():
+            pendientes.get_nowait()
+        pendientes.put_nowait(None)
+
+
+async def _siguiente_lote_telemetria(pendientes: asyncio.Queue) -> Optional[list]:
+    """Espera un mensaje y junta los que lleguen en los siguientes TELEMETRIA_LOTE_MS.
+
+    Devuelve None si la conexión se cerró: los mensajes aún sin aplicar se descartan,
+    ya que su acuse no podría llegar al cliente.
+    """
+    loop = asyncio.get_running_loop()
+    primero = await pendientes.get()
+    if primero is None:
+        return None
+    lote = [primero]
+    limite = loop.time() + TELEMETRIA_LOTE_MS / 1000
+    while len(lote) < TELEMETRIA_LOTE_MAX:
+        try:
+            siguiente = pendientes.get_nowait()
+        except asyncio.QueueEmpty:
+            restante = limite - loop.time()
+            if restante <= 0:
+                break
+            try:
+                siguiente = await asyncio.wait_for(pendientes.get(), restante)
+            except asyncio.TimeoutError:
+                break
+        if siguiente is None:
+            return None
+        lote.append(siguiente)
+    return lote
+
+
+async def _aplicar_telemetria(db: BaseDatosFragmentada, serial: int, lote: list) -> list:
+    """Aplica un lote de mensajes de una máquina y devuelve el resultado de cada uno, en orden."""
+    catalogo = await catalogo_productos.vigente(db)
+    resultados, operaciones, tipos = [], [], []
+    for mensaje in lote:
+        try:
+            evento = EventoTelemetria.model_validate_json(mensaje)
+        except ValidationError as e:
+            resultados.append({"id": None, "codigo": 422, "detalle": "Evento inválido", "campos": _campos_invalidos(e)})
+            tipos.append("desconocido")
+            continue
+        tipos.append(evento.tipo if evento.tipo in TIPOS_TELEMETRIA else "desconocido")
+        try:
+            operacion = _operacion_telemetria(serial, evento, catalogo)
+        except HTTPException as e:
+            resultados.append({"id": evento.id, "codigo": e.status_code, "detalle": e.detail})
+            continue
+        resultados.append({"id": evento.id, "codigo": 200})
+        if operacion is not None:
+            operaciones.append((resultados[-1], evento, operacion))
+
+    if operaciones:
+        inicio = time.perf_counter()
+        try:
+            aplicadas = await db.para_maquina(serial).escribir_lote([operacion for _, _, operacion in operaciones])
+        except Exception as e:
+            error = HTTPException(status_code=500, detail=str(e)) if isinstance(e, sqlite3.Error) else e
+            aplicadas = [(False, error)] * len(operaciones)
+        metricas.observar("maquinas_ws_lote_duracion_segundos", (), time.perf_counter() - inicio)
+
+        for (resultado, evento, (_, args)), (correcto, valor) in zip(operaciones, aplicadas):
+            if correcto:
+                resultado["respuesta"] = valor
+                tipo, datos = _cambio_telemetria(evento, args, valor)
+                notificar_cambio(serial, tipo, **datos)
+            elif isinstance(valor, HTTPException):
+                resultado.update(codigo=valor.status_code, detalle=valor.detail)
+            else:
+                resultado.update(codigo=500, detalle=str(valor))
+
+    for tipo, resultado in zip(tipos, resultados):
+        metricas.incrementar("maquinas_ws_eventos_total", (("tipo", tipo), ("codigo", resultado["codigo"])))
+    return resultados
+
+
+def _campos_invalidos(error: ValidationError) -> list:
+    """Campos rechazados por la validación, sin repetir los valores recibidos; vacío si el JSON no se pudo leer."""
+    campos = (".".join(str(parte) for parte in detalle["loc"]) for detalle in error.errors())
+    return sorted({campo for campo in campos if campo})
+
+
+def _operacion_telemetria(serial: int, evento: EventoTelemetria, catalogo: dict) -> Optional[tuple]:
+    """Escritura (funcion, args) que corresponde a un evento; None para los latidos, que no escriben."""
+    def requerir(*campos):
+        faltantes = [campo for campo in campos if getattr(evento, campo) is None]
+        if faltantes:
+            raise HTTPException(status_code=422, detail=f"Faltan campos para '{evento.tipo}': {', '.join(faltantes)}")
+
+    if evento.tipo == "latido":
+        return None
+    if evento.tipo == "venta":
+        requerir("num_serie")
+        venta = Venta(id_maquina=serial, num_serie=evento.num_serie, cantidad=evento.cantidad, num_slot=evento.num_slot)
+        return _realizar_venta, (venta, catalogo.get(venta.num_serie))
+    if evento.tipo == "estado":
+        requerir("estado")
+        if evento.estado not in ("encendida", "apagada"):
+            raise HTTPException(status_code=422, detail="El estado debe ser 'encendida' o 'apagada'")
+        return (_encender_maquina if evento.estado == "encendida" else _apagar_maquina), (serial,)
+    if evento.tipo == "relleno":
+        requerir("productos_restantes")
+        ahora = datetime.now()
+        return _solicitud_relleno_por_Maquina, (serial, evento.productos_restantes,
+                                                evento.fecha or ahora.strftime("%Y-%m-%d"), evento.hora or ahora.strftime("%H:%M:%S"))
+    if evento.tipo == "incidencia":
+        requerir("descripcion", "nombre_persona")
+        return _crear_incidencia, (evento.descripcion, serial, evento.nombre_persona)
+    raise HTTPException(status_code=422, detail=f"Tipo de evento desconocido; se admiten: {', '.join(TIPOS_TELEMETRIA)}")
+
+
+def _cambio_telemetria(evento: EventoTelemetria, args: tuple, respuesta: dict) -> tuple:
+    """Tipo y datos con que se publica en /eventos/ un evento ya aplicado, igual que desde su endpoint HTTP."""
+    if evento.tipo == "venta":
+        return "venta", {"num_serie": evento.num_serie, "cantidad": evento.cantidad, "num_slot": respuesta["num_slot"],
+                         "monto_total": respuesta["monto_total"]}
+    if evento.tipo == "estado":
+        return "estado", {"estado": evento.estado}
+    if evento.tipo == "relleno":
+        return "relleno", {"productos_restantes": evento.productos_restantes, "fecha": args[2], "hora": args[3]}
+    return "incidencia", {"id_incidencia": respuesta["id_incidencia"], "descripcion": evento.descripcion,
+                          "nombre_persona": evento.nombre_persona}
+
+
+def _maquina_existe(conexion: sqlite3.Connection, serial: int) -> bool:
+    try:
+        return conexion.execute("SELECT 1 FROM maquinas WHERE serial = ?", (serial,)).fetchone() is not None
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 if __name__ == "_main_":
     import uvicorn
 
-    uvicorn.run(app, host="127.0.0.1", port=5550)
\ No newline at end of file
+    uvicorn.run(app, host="127.0.0.1", port=5550)
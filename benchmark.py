@@ -0,0 +1,304 @@
+"""Pruebas de carga reproducibles para la API de máquinas expendedoras.
+
+Crea una flota sintética en una base de datos temporal, ejecuta la aplicación ASGI
+dentro del mismo proceso y mide el rendimiento de los endpoints más usados.
+
+Uso:
+    python benchmark.py --maquinas 10000 --ventas 2000000 --salida resultados.json
+    python benchmark.py --comparar resultados_anteriores.json
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+NUM_PRODUCTOS = 50
+EXISTENCIAS_INICIALES = 1_000_000
+
+
+def sembrar_flota(db, maquinas: int, slots: int, ventas: int, semilla: int, incidencias: int = 0):
+    """Llena la base con máquinas encendidas, slots con existencias, historial de ventas e incidencias.
+
+    `db` es la BaseDatosFragmentada de la aplicación: el catálogo y cada fragmento se siembran en su archivo.
+    """
+    aleatorio = random.Random(semilla)
+    catalogo = sqlite3.connect(db.catalogo.pool.ruta)
+    catalogo.executemany("INSERT OR IGNORE INTO productos (num_serie, nombre, precio) VALUES (?, ?, ?)",
+                         [(num, f"Producto {num}", round(aleatorio.uniform(8, 40), 2)) for num in range(1, NUM_PRODUCTOS + 1)])
+    precios = dict(catalogo.execute("SELECT num_serie, precio FROM productos").fetchall())
+    catalogo.commit()
+    catalogo.close()
+
+    conexiones = [sqlite3.connect(fragmento.pool.ruta) for fragmento in db.fragmentos]
+    for indice, conexion in enumerate(conexiones):
+        seriales = range(indice or len(conexiones), maquinas + 1, len(conexiones))
+        conexion.executemany("INSERT INTO maquinas (serial, ubicacion, direccion, estado) VALUES (?, ?, ?, 'encendida')",
+                             ((serial, f"Región {serial % 20}", f"Calle {serial}") for serial in seriales))
+        # Existencias holgadas para que las ventas del benchmark no se queden sin producto
+        conexion.executemany("INSERT INTO slots (serial_maquina, num_slot, capacidad_maxima) VALUES (?, ?, ?)",
+                             ((serial, num, EXISTENCIAS_INICIALES) for serial in seriales for num in range(slots)))
+        conexion.executemany("INSERT INTO inventario (serie_maquina, num_slot, num_serie, cantidad, ultimo_resurtido) VALUES (?, ?, ?, ?, ?)",
+                             ((serial, num, num % NUM_PRODUCTOS + 1, EXISTENCIAS_INICIALES, datetime.now())
+                              for serial in seriales for num in range(slots)))
+        conexion.execute("INSERT INTO resurtidos (serie_maquina, num_serie, cantidad, fecha, num_slot) "
+                         "SELECT serie_maquina, num_serie, cantidad, ultimo_resurtido, num_slot FROM inventario")
+
+    inicio = int(time.time()) - 365 * 24 * 3600
+    pendientes = [[] for _ in conexiones]
+
+    def volcar(indice):
+        conexiones[indice].executemany("INSERT INTO ventas (serie_maquina, num_serie, nombre_producto, monto, cantidad, fecha) "
+                                       "VALUES (?, ?, ?, ?, ?, ?)", pendientes[indice])
+        pendientes[indice].clear()
+
+    for _ in range(ventas):
+        serial, num_serie = aleatorio.randint(1, maquinas), aleatorio.randint(1, NUM_PRODUCTOS)
+        cantidad = aleatorio.randint(1, 3)
+        indice = serial % len(conexiones)
+        pendientes[indice].append((serial, num_serie, f"Producto {num_serie}", precios[num_serie] * cantidad,
+                                   cantidad, inicio + aleatorio.randint(0, 365 * 24 * 3600)))
+        if len(pendientes[indice]) >= 50_000:
+            volcar(indice)
+
+    # Con varios fragmentos, el id de cada incidencia determina su fragmento (id ≡ fragmento + 1, mód N)
+    for indice, conexion in enumerate(conexiones):
+        conexion.executemany("INSERT INTO incidencias (id, descripcion, serie_maquina, fecha, nombre_persona) VALUES (?, ?, ?, ?, ?)",
+                             ((id_incidencia, f"Incidencia {id_incidencia}",
+                               aleatorio.randrange(indice or len(conexiones), maquinas + 1, len(conexiones)),
+                               datetime.fromtimestamp(inicio + aleatorio.randint(0, 365 * 24 * 3600)).strftime("%Y-%m-%d %H:%M:%S"),
+                               "Benchmark")
+                              for id_incidencia in range(indice + 1, incidencias + 1, len(conexiones))))
+
+    for indice, conexion in enumerate(conexiones):
+        volcar(indice)
+        conexion.commit()
+        conexion.execute("ANALYZE")
+        conexion.close()
+
+
+def por_lote(generador, operaciones: int):
+    """Marca un escenario cuyas peticiones agrupan varias operaciones, para medirlo también por operación."""
+    generador.operaciones = operaciones
+    return generador
+
+
+def escenarios(maquinas: int, slots: int, incidencias: int, tamano_lote: int = 100):
+    """Cada escenario devuelve (método, ruta, parámetros, cuerpo) para una petición aleatoria."""
+    def maquina():
+        return random.randint(1, maquinas)
+
+    def cuerpo_venta():
+        serial, slot = maquina(), random.randrange(slots)
+        return {"id_maquina": serial, "num_serie": slot % NUM_PRODUCTOS + 1, "cantidad": 1}
+
+    def venta():
+        return "POST", "/venta/", None, cuerpo_venta()
+
+    def ventas_lote():
+        return "POST", "/ventas/batch", None, [cuerpo_venta() for _ in range(tamano_lote)]
+
+    # Las altas usan seriales nuevos, por encima de la flota sembrada, para no chocar entre escenarios
+    seriales_nuevos = itertools.count(maquinas + 1)
+
+    def cuerpo_alta():
+        serial = next(seriales_nuevos)
+        return {"serial": serial, "ubicacion": f"Región {serial % 20}", "direccion": f"Calle {serial}", "num_slots": slots}
+
+    def alta():
+        cuerpo = cuerpo_alta()
+        return "POST", f"/maquinas/{cuerpo['serial']}", {"ubicacion": cuerpo["ubicacion"], "direccion": cuerpo["direccion"]}, None
+
+    def alta_lote():
+        return "POST", "/maquinas/lote", None, [cuerpo_alta() for _ in range(tamano_lote)]
+
+    def resurtir():
+        serial, slot = maquina(), random.randrange(slots)
+        return "POST", "/resurtir/", {"serie_maquina": serial, "num_serie": slot % NUM_PRODUCTOS + 1,
+                                      "cantidad": 5, "num_slot": slot}, None
+
+    def pagina_incidencias(**parametros):
+        return lambda: ("GET", "/incidencias/", dict(parametros, limite=1000,
+                                                     despues_de=random.randint(0, max(0, incidencias - 1000))), None)
+
+    return {
+        "venta": venta,
+        # Las mismas ventas enviadas de `tamano_lote` en `tamano_lote`; comparar con "venta" en ventas/s
+        "ventas_lote": por_lote(ventas_lote, tamano_lote),
+        "resurtir": resurtir,
+        "alta": alta,
+        "alta_lote": por_lote(alta_lote, tamano_lote),
+        "estado_maquina": lambda: ("GET", f"/maquinas/{maquina()}/estado", None, None),
+        "productos_maquina": lambda: ("GET", f"/productos/{maquina()}", None, None),
+        "ganancia_total_ventas": lambda: ("GET", f"/ganancia-total-ventas/{maquina()}", None, None),
+        "monto_mas_alto": lambda: ("GET", "/MontoMensualMasAlto/", None, None),
+        "monto_mas_bajo": lambda: ("GET", "/MontoMensualMasBajo/", None, None),
+        # Respuestas grandes, completas y con proyección de campos
+        "incidencias_1000": pagina_incidencias(),
+        "incidencias_1000_campos": pagina_incidencias(fields="id,fecha"),
+        "estado_maquina_campos": lambda: ("GET", f"/maquinas/{maquina()}/estado",
+                                          {"fields": "serial,estado,ganancia_total_ventas"}, None),
+        # El calentamiento hace la carga inicial del historial; se mide el refresco incremental
+        "pronostico_relleno": lambda: ("GET", "/pronostico-relleno/", {"limite": 100}, None),
+    }
+
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    indice = min(len(valores) - 1, max(0, round(p / 100 * len(valores)) - 1))
+    return valores[indice]
+
+
+async def medir(cliente, generador, peticiones: int, concurrencia: int) -> dict:
+    latencias, errores = [], 0
+    pendientes = iter(range(peticiones))
+
+    async def trabajador():
+        nonlocal errores
+        for _ in pendientes:
+            metodo, ruta, parametros, cuerpo = generador()
+            inicio = time.perf_counter()
+            respuesta = await cliente.request(metodo, ruta, params=parametros, json=cuerpo)
+            latencias.append(time.perf_counter() - inicio)
+            if respuesta.status_code >= 400:
+                errores += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        "peticiones": peticiones,
+        "errores": errores,
+        "segundos": round(duracion, 3),
+        "peticiones_por_segundo": round(peticiones / duracion, 1),
+        "p50_ms": round(percentil(latencias, 50) * 1000, 3),
+        "p95_ms": round(percentil(latencias, 95) * 1000, 3),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 3),
+    }
+
+
+async def ejecutar_benchmark(modulo, args) -> dict:
+    import httpx
+
+    transporte = httpx.ASGITransport(app=modulo.app)
+    resultados = {}
+    async with httpx.AsyncClient(transport=transporte, base_url="http://benchmark") as cliente:
+        for nombre, generador in escenarios(args.maquinas, args.slots, args.incidencias, args.tamano_lote).items():
+            if args.solo and nombre not in args.solo:
+                continue
+            # Calentar cachés y conexiones antes de medir
+            await medir(cliente, generador, min(100, args.peticiones), args.concurrencia)
+            resultados[nombre] = medida = await medir(cliente, generador, args.peticiones, args.concurrencia)
+            medida["operaciones_por_segundo"] = round(medida["peticiones_por_segundo"] * getattr(generador, "operaciones", 1), 1)
+            print(f"{nombre:24} {medida['peticiones_por_segundo']:>10} pet/s  {medida['operaciones_por_segundo']:>10} op/s  "
+                  f"p50 {medida['p50_ms']:>8} ms  p95 {medida['p95_ms']:>8} ms  "
+                  f"p99 {medida['p99_ms']:>8} ms  errores {medida['errores']}")
+
+    # Ganancia de cada escritura por lotes frente a la misma escritura de una en una
+    for lote, individual in (("ventas_lote", "venta"), ("alta_lote", "alta")):
+        if lote in resultados and individual in resultados:
+            ganancia = resultados[lote]["operaciones_por_segundo"] / resultados[individual]["operaciones_por_segundo"]
+            print(f"{lote} frente a {individual}: {ganancia:.1f}x operaciones por segundo")
+    return resultados
+
+
+def commit_actual() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def comparar(actual: dict, ruta_anterior: str):
+    with open(ruta_anterior, encoding="utf-8") as archivo:
+        anterior = json.load(archivo)
+    print(f"\nComparación con {anterior.get('commit') or ruta_anterior}:")
+    for nombre, medida in actual["resultados"].items():
+        previa = anterior.get("resultados", {}).get(nombre)
+        if not previa:
+            continue
+        cambio = (medida["peticiones_por_segundo"] / previa["peticiones_por_segundo"] - 1) * 100
+        print(f"{nombre:24} {cambio:+7.1f}% pet/s  p99 {previa['p99_ms']} -> {medida['p99_ms']} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--maquinas", type=int, default=10000)
+    parser.add_argument("--slots", type=int, default=30)
+    parser.add_argument("--ventas", type=int, default=2000000, help="ventas históricas a sembrar")
+    parser.add_argument("--incidencias", type=int, default=100000, help="incidencias a sembrar")
+    parser.add_argument("--peticiones", type=int, default=2000, help="peticiones medidas por endpoint")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--tamano-lote", type=int, default=100, help="operaciones por petición en los escenarios por lotes")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--solo", nargs="*", help="medir solo estos escenarios")
+    parser.add_argument("--escritura-agrupada", action="store_true",
+                        help="confirmar ventas y resurtidos por lotes (MAQUINAS_GROUP_COMMIT=1)")
+    parser.add_argument("--fragmentos", type=int, default=1,
+                        help="repartir las máquinas en este número de archivos SQLite (MAQUINAS_SHARDS)")
+    parser.add_argument("--db", help="reutilizar esta base ya sembrada en lugar de crear una temporal")
+    parser.add_argument("--salida", default="resultados_benchmark.json")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    random.seed(args.semilla)
+    directorio = tempfile.mkdtemp(prefix="benchmark_maquinas_")
+    ruta = args.db or os.path.join(directorio, "registro.db")
+    os.environ["MAQUINAS_DB"] = ruta
+    os.environ["MAQUINAS_SHARDS"] = str(args.fragmentos)
+    if args.escritura_agrupada:
+        os.environ["MAQUINAS_GROUP_COMMIT"] = "1"
+
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    modulo = importlib.import_module("MáquinaExp")
+    sembrar = not os.path.exists(modulo.db.catalogo.pool.ruta)
+    modulo.db.migrar()
+
+    if sembrar:
+        inicio = time.perf_counter()
+        sembrar_flota(modulo.db, args.maquinas, args.slots, args.ventas, args.semilla, args.incidencias)
+        print(f"Flota sembrada en {time.perf_counter() - inicio:.1f} s ({ruta})")
+
+    async def ejecutar():
+        try:
+            return await ejecutar_benchmark(modulo, args)
+        finally:
+            await modulo.db.detener()
+
+    try:
+        resultados = asyncio.run(ejecutar())
+    finally:
+        modulo.db.cerrar()
+        if not args.db:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+    salida = {
+        "commit": commit_actual(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "parametros": {clave: valor for clave, valor in vars(args).items() if clave not in ("salida", "comparar")},
+        "serializador": "orjson" if modulo.orjson is not None else "json",
+        "resultados": resultados,
+    }
+    with open(args.salida, "w", encoding="utf-8") as archivo:
+        json.dump(salida, archivo, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {args.salida}")
+
+    if args.comparar:
+        comparar(salida, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
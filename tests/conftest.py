@@ -0,0 +1,49 @@
+import asyncio
+import importlib
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+# La base se elige al importar la aplicación: cada sesión de pruebas usa una temporal
+os.environ.setdefault("MAQUINAS_DB", os.path.join(tempfile.mkdtemp(prefix="maquinas_pruebas_"), "registro.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def maquinas():
+    modulo = importlib.import_module("MáquinaExp")
+    modulo.db.migrar()
+    yield modulo
+    modulo.db.cerrar()
+
+
+def en_bucle(db, corrutina):
+    """Ejecuta `corrutina` en un bucle nuevo y detiene al final los escritores agrupados arrancados en él.
+
+    Las pruebas no pasan por el ciclo de vida de la aplicación; sin detenerlos, con
+    MAQUINAS_GROUP_COMMIT=1 el escritor quedaría atado a un bucle ya cerrado.
+    """
+    async def completa():
+        try:
+            return await corrutina
+        finally:
+            await db.detener()
+    return asyncio.run(completa())
+
+
+def cliente(modulo) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=modulo.app), base_url="http://pruebas")
+
+
+async def preparar_maquina(cliente: httpx.AsyncClient, serial: int, existencias: int = 0, num_serie: int = 1, num_slot: int = 0):
+    """Da de alta una máquina encendida con `existencias` unidades de un producto en un slot."""
+    respuesta = await cliente.post(f"/maquinas/{serial}", params={"ubicacion": "Pruebas", "direccion": f"Calle {serial}"})
+    assert respuesta.status_code == 200, respuesta.text
+    assert (await cliente.post(f"/encender_maquina/{serial}")).status_code == 200
+    if existencias:
+        respuesta = await cliente.post("/resurtir/", params={"serie_maquina": serial, "num_serie": num_serie,
+                                                             "cantidad": existencias, "num_slot": num_slot})
+        assert respuesta.status_code == 200, respuesta.text
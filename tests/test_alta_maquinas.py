@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import cliente, en_bucle
+
+
+@pytest.mark.parametrize("campo, valor", [("num_slots", 0), ("num_slots", 10**6),
+                                          ("capacidad_por_slot", -1), ("capacidad_por_slot", 10**9)])
+def test_alta_masiva_fuera_de_limites_se_rechaza(maquinas, campo, valor):
+    async def escenario():
+        async with cliente(maquinas) as c:
+            return await c.post("/maquinas/lote", json=[{"serial": 4001, "ubicacion": "Pruebas", "direccion": "",
+                                                         campo: valor}])
+
+    assert en_bucle(maquinas.db, escenario()).status_code == 422
+
+
+def test_alta_masiva_crea_los_slots_pedidos(maquinas):
+    async def escenario():
+        async with cliente(maquinas) as c:
+            respuesta = await c.post("/maquinas/lote", json=[{"serial": 4002, "ubicacion": "Pruebas", "direccion": "",
+                                                              "num_slots": maquinas.MAX_SLOTS_POR_MAQUINA,
+                                                              "capacidad_por_slot": 3}])
+            assert respuesta.status_code == 200, respuesta.text
+            return (await c.get("/maquinas/4002/estado")).json()
+
+    estado = en_bucle(maquinas.db, escenario())
+    assert estado["numero_de_slots"] == maquinas.MAX_SLOTS_POR_MAQUINA
+    assert estado["capacidad_de_cada_slot"] == 3 * maquinas.MAX_SLOTS_POR_MAQUINA
+
+
+def test_alta_masiva_limita_los_slots_del_lote(maquinas):
+    por_maquina = maquinas.MAX_SLOTS_POR_MAQUINA
+    lote = [{"serial": 4100 + i, "ubicacion": "Pruebas", "direccion": "", "num_slots": por_maquina}
+            for i in range(maquinas.MAX_SLOTS_POR_LOTE // por_maquina + 1)]
+
+    async def escenario():
+        async with cliente(maquinas) as c:
+            return await c.post("/maquinas/lote", json=lote)
+
+    respuesta = en_bucle(maquinas.db, escenario())
+    assert respuesta.status_code == 400, respuesta.text
+    assert str(maquinas.MAX_SLOTS_POR_LOTE) in respuesta.json()["detail"]
+
+
+def test_alta_masiva_distingue_seriales_repetidos_de_existentes(maquinas):
+    async def escenario():
+        async with cliente(maquinas) as c:
+            alta = {"ubicacion": "Pruebas", "direccion": "", "num_slots": 2}
+            assert (await c.post("/maquinas/lote", json=[{"serial": 4003, **alta}])).status_code == 200
+            respuesta = await c.post("/maquinas/lote", json=[{"serial": 4003, **alta}, {"serial": 4004, **alta},
+                                                              {"serial": 4004, **alta, "num_slots": 5}])
+            assert respuesta.status_code == 200, respuesta.text
+            return respuesta.json(), (await c.get("/maquinas/4004/estado")).json()
+
+    resultado, estado = en_bucle(maquinas.db, escenario())
+    assert resultado["creadas"] == [4004]
+    assert [conflicto["serial"] for conflicto in resultado["conflictos"]] == [4003, 4004]
+    assert "ya existente" in resultado["conflictos"][0]["detalle"]
+    assert "repetido en el lote" in resultado["conflictos"][1]["detalle"]
+    assert estado["numero_de_slots"] == 2
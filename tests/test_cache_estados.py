@@ -0,0 +1,30 @@
+import time
+
+
+def test_limpiar_descarta_lecturas_de_maquinas_sin_entrada(maquinas):
+    cache = maquinas.CacheEstados()
+    # La lectura empieza antes de que cambie el catálogo y la máquina aún no tenía entrada
+    generacion = cache.generacion(1)
+    cache.limpiar()
+    cache.guardar(1, generacion, {"serial": 1, "productos": ["precio anterior"]})
+    assert cache.obtener(1) is None
+
+    cache.guardar(1, cache.generacion(1), {"serial": 1, "productos": ["precio nuevo"]})
+    assert cache.obtener(1)[1]["productos"] == ["precio nuevo"]
+
+
+def test_invalidar_descarta_lecturas_en_curso(maquinas):
+    cache = maquinas.CacheEstados()
+    generacion = cache.generacion(1)
+    cache.invalidar(1)
+    cache.guardar(1, generacion, {"serial": 1})
+    assert cache.obtener(1) is None
+
+
+def test_las_entradas_caducan(maquinas):
+    cache = maquinas.CacheEstados(ttl=0.05)
+    etag, _ = cache.guardar(1, cache.generacion(1), {"serial": 1})
+    assert cache.obtener(1)[0] == etag
+    # Una escritura de otro proceso no pasa por invalidar: la ficha se vuelve a leer al caducar
+    time.sleep(0.06)
+    assert cache.obtener(1) is None
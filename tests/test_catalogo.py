@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class CatalogoFalso:
+    """Base del catálogo en memoria; `durante` simula una escritura mientras una consulta está en curso."""
+
+    def __init__(self, maquinas):
+        self.maquinas = maquinas
+        self.version = 1
+        self.durante = None
+
+    async def ejecutar(self, funcion):
+        version = self.version
+        if self.durante is not None:
+            durante, self.durante = self.durante, None
+            durante()
+        await asyncio.sleep(0)
+        if funcion is self.maquinas._version_catalogo:
+            return version
+        return version, {1: ("Soles", 15.5 if version == 1 else 20.0)}
+
+
+def test_invalidar_durante_la_verificacion_no_se_pierde(maquinas):
+    catalogo = maquinas.CatalogoProductos(ttl=60)
+    base = CatalogoFalso(maquinas)
+    db = SimpleNamespace(catalogo=base)
+
+    def cambiar_precio():
+        # Otra petición de este proceso confirma un cambio de precio e invalida el catálogo
+        base.version = 2
+        catalogo.invalidar()
+
+    async def escenario():
+        assert (await catalogo.vigente(db))[1][1] == 15.5
+        catalogo.invalidar()
+        base.durante = cambiar_precio
+        # Esta verificación leyó la versión anterior al cambio
+        await catalogo.vigente(db)
+        return await catalogo.vigente(db)
+
+    assert asyncio.run(escenario())[1][1] == 20.0
@@ -0,0 +1,25 @@
+from fastapi.testclient import TestClient
+
+
+def test_la_aplicacion_arranca_dos_veces_en_el_mismo_proceso(maquinas):
+    venta = {"id_maquina": 5001, "num_serie": 1, "cantidad": 1}
+    cabeceras = {"Idempotency-Key": "ciclo-de-vida-1"}
+
+    with TestClient(maquinas.app) as c:
+        # El arranque migró la base y precargó el catálogo
+        assert maquinas.catalogo_productos.productos
+        assert c.post("/maquinas/5001", params={"ubicacion": "Pruebas", "direccion": "Calle 5001"}).status_code == 200
+        assert c.post("/encender_maquina/5001").status_code == 200
+        assert c.post("/resurtir/", params={"serie_maquina": 5001, "num_serie": 1, "cantidad": 5, "num_slot": 0}).status_code == 200
+        primera = c.post("/venta/", json=venta, headers=cabeceras)
+        assert primera.status_code == 200, primera.text
+
+    # Un segundo arranque tras cerrar: el ejecutor se vuelve a crear y las claves se recargan de la base
+    maquinas.claves_idempotencia._entradas.clear()
+    with TestClient(maquinas.app) as c:
+        assert maquinas.claves_idempotencia._entradas
+        repetida = c.post("/venta/", json=venta, headers=cabeceras)
+        assert repetida.status_code == 200, repetida.text
+        assert repetida.headers["Idempotent-Replayed"] == "true"
+        assert repetida.json() == primera.json()
+        assert c.get("/productos/5001").status_code == 200
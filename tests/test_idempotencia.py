@@ -0,0 +1,46 @@
+import sqlite3
+import threading
+import time
+
+CATALOGO = {1: ("Soles", 15.5)}
+
+
+def test_misma_clave_en_dos_conexiones_vende_una_vez(maquinas, tmp_path):
+    ruta = str(tmp_path / "idempotencia.db")
+    maquinas.migrar_base_datos(ruta)
+    conexiones = [sqlite3.connect(ruta, timeout=5, check_same_thread=False) for _ in range(2)]
+    conexiones[0].execute("INSERT INTO maquinas (serial, ubicacion, direccion, estado) VALUES (1, 'Pruebas', '', 'encendida')")
+    conexiones[0].execute("INSERT INTO slots (serial_maquina, num_slot, capacidad_maxima) VALUES (1, 0, 10)")
+    maquinas._resurtir_producto(conexiones[0], 1, 1, 5, 0)
+    conexiones[0].commit()
+
+    def venta_lenta(conexion, venta, producto):
+        # Deja tiempo para que la otra conexión busque la clave mientras esta aún no la guarda
+        resultado = maquinas._realizar_venta(conexion, venta, producto)
+        time.sleep(0.2)
+        return resultado
+
+    venta = maquinas.Venta(id_maquina=1, num_serie=1)
+    llave, huella = ("/venta/", 1, "reintento-1"), "huella"
+    inicio = threading.Barrier(2)
+    resultados = []
+
+    def vender(conexion):
+        inicio.wait()
+        resultados.append(maquinas._confirmar(conexion, maquinas._escribir_idempotente,
+                                              (llave, huella, 3600, venta_lenta, (venta, CATALOGO[1]))))
+
+    hilos = [threading.Thread(target=vender, args=(conexion,)) for conexion in conexiones]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    try:
+        assert sorted(repetida for _, repetida in resultados) == [False, True]
+        assert resultados[0][0] == resultados[1][0]
+        assert conexiones[0].execute("SELECT cantidad FROM inventario WHERE serie_maquina = 1").fetchone()[0] == 4
+        assert conexiones[0].execute("SELECT COUNT(*) FROM ventas").fetchone()[0] == 1
+    finally:
+        for conexion in conexiones:
+            conexion.close()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+from conftest import en_bucle
+
+
+def test_escrituras_simultaneas_no_repiten_ids_en_un_fragmento(maquinas, tmp_path):
+    db = maquinas.BaseDatosFragmentada(str(tmp_path / "fragmentada.db"), 2)
+    db.migrar()
+
+    async def escenario():
+        fragmento = db.para_maquina(2)
+        await fragmento.ejecutar(maquinas._crear_maquina, 2, "Pruebas", "Calle 2")
+        incidencias = [fragmento.escribir(maquinas._crear_incidencia, f"Incidencia {numero}", 2, "Pruebas")
+                       for numero in range(100)]
+        solicitudes = [fragmento.escribir(maquinas._solicitud_relleno_por_Maquina, 2, 10, "2024-01-01", "10:00:00")
+                       for _ in range(100)]
+        await asyncio.gather(*incidencias, *solicitudes)
+
+        def leer_ids(conexion):
+            return [[fila[0] for fila in conexion.execute(f"SELECT id FROM {tabla}")]
+                    for tabla in ("incidencias", "solicitudes_relleno")]
+        return await fragmento.ejecutar(leer_ids)
+
+    try:
+        for ids in en_bucle(db, escenario()):
+            # Todas las escrituras se guardaron, con ids propios del fragmento 0 (≡ 1, mód 2)
+            assert len(ids) == len(set(ids)) == 100
+            assert all(id_fila % 2 == 1 for id_fila in ids)
+    finally:
+        db.cerrar()
+
+
+def _tablas(ruta: str) -> set:
+    conexion = sqlite3.connect(ruta)
+    try:
+        return {fila[0] for fila in conexion.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        conexion.close()
+
+
+def test_catalogo_y_fragmentos_tienen_esquemas_separados(maquinas, tmp_path):
+    db = maquinas.BaseDatosFragmentada(str(tmp_path / "registro.db"), 2)
+    db.migrar()
+    try:
+        catalogo = _tablas(db.catalogo.pool.ruta)
+        assert {"productos", "catalogo_version"} <= catalogo
+        assert "maquinas" not in catalogo and "ventas" not in catalogo
+        for fragmento in db.fragmentos:
+            tablas = _tablas(fragmento.pool.ruta)
+            assert {"maquinas", "ventas", "inventario", "claves_idempotencia"} <= tablas
+            assert "productos" not in tablas and "catalogo_version" not in tablas
+            # "productos" se resuelve al catálogo adjunto
+            nombres = en_bucle(db, fragmento.ejecutar(lambda conexion: conexion.execute("SELECT nombre FROM productos").fetchall()))
+            assert [nombre for nombre, in nombres] == [nombre for nombre, _ in maquinas.PRODUCTOS_INICIALES]
+    finally:
+        db.cerrar()
+
+
+def test_no_arranca_fragmentado_sobre_una_base_con_datos(maquinas, tmp_path):
+    ruta = str(tmp_path / "registro.db")
+    maquinas.migrar_base_datos(ruta)
+    conexion = sqlite3.connect(ruta)
+    conexion.execute("INSERT INTO maquinas (serial, ubicacion, direccion) VALUES (1, 'Pruebas', '')")
+    conexion.commit()
+    conexion.close()
+
+    db = maquinas.BaseDatosFragmentada(ruta, 2)
+    try:
+        with pytest.raises(RuntimeError, match="MAQUINAS_SHARDS=1"):
+            db.migrar()
+        # No se crearon fragmentos vacíos junto a la base existente
+        assert sorted(os.listdir(tmp_path)) == ["registro.db"]
+    finally:
+        db.cerrar()
@@ -0,0 +1,38 @@
+import asyncio
+import sqlite3
+import time
+
+from conftest import cliente, en_bucle, preparar_maquina
+
+# Consulta de lectura que tarda alrededor de un segundo sin depender del volumen de datos
+REPORTE_LENTO = ("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 2500000) "
+                 "SELECT COUNT(*) FROM n")
+
+
+def _reporte_lento(conexion: sqlite3.Connection):
+    inicio = time.perf_counter()
+    conexion.execute(REPORTE_LENTO).fetchone()
+    return time.perf_counter() - inicio
+
+
+def test_ventas_no_esperan_a_un_reporte_lento(maquinas):
+    async def escenario():
+        async with cliente(maquinas) as c:
+            await preparar_maquina(c, 2001, existencias=100)
+            reporte = asyncio.create_task(maquinas.db.para_maquina(2001).ejecutar(_reporte_lento))
+            await asyncio.sleep(0.05)
+
+            async def vender():
+                inicio = time.perf_counter()
+                respuesta = await c.post("/venta/", json={"id_maquina": 2001, "num_serie": 1, "cantidad": 1})
+                assert respuesta.status_code == 200, respuesta.text
+                return time.perf_counter() - inicio
+
+            latencias = await asyncio.gather(*(vender() for _ in range(20)))
+            reporte_en_curso = not reporte.done()
+            return latencias, reporte_en_curso, await reporte
+
+    latencias, reporte_en_curso, duracion_reporte = en_bucle(maquinas.db, escenario())
+    # Las ventas terminan mientras el reporte sigue leyendo y ninguna tarda lo que él
+    assert reporte_en_curso
+    assert max(latencias) < duracion_reporte / 2, (max(latencias), duracion_reporte)
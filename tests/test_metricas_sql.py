@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+
+def test_base_bloqueada_se_cuenta_sin_reintentar(maquinas, tmp_path):
+    ruta = str(tmp_path / "bloqueada.db")
+    bloqueo = sqlite3.connect(ruta)
+    bloqueo.execute("CREATE TABLE slots (serial_maquina INTEGER, num_slot INTEGER)")
+    bloqueo.commit()
+    conexion = sqlite3.connect(ruta, timeout=0, factory=maquinas.ConexionInstrumentada)
+
+    sql = "INSERT INTO slots (serial_maquina, num_slot) VALUES (?, ?)"
+    etiqueta = ("maquinas_sql_bloqueos_total", (("sentencia", maquinas._etiqueta_sentencia(sql)),))
+    antes = maquinas.metricas._contadores.get(etiqueta, 0)
+    filas = ((1, num) for num in range(30))
+
+    bloqueo.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            conexion.executemany(sql, filas)
+    finally:
+        bloqueo.rollback()
+
+    # Un solo intento y el error llega al llamador, que decide si repetir la transacción completa
+    assert maquinas.metricas._contadores.get(etiqueta, 0) == antes + 1
+    conexion.executemany(sql, ((1, num) for num in range(30)))
+    conexion.commit()
+    assert conexion.execute("SELECT COUNT(*) FROM slots").fetchone()[0] == 30
+    conexion.close()
+    bloqueo.close()
@@ -0,0 +1,151 @@
+import random
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+CATALOGO = {1: ("Soles", 15.5)}
+
+
+@pytest.fixture
+def conexion(maquinas, tmp_path):
+    """Base recién migrada con una máquina encendida y existencias en un slot."""
+    ruta = str(tmp_path / "planes.db")
+    maquinas.migrar_base_datos(ruta)
+    conexion = sqlite3.connect(ruta)
+    conexion.execute("INSERT INTO maquinas (serial, ubicacion, direccion, estado) VALUES (1, 'Pruebas', '', 'encendida')")
+    conexion.execute("INSERT INTO slots (serial_maquina, num_slot, capacidad_maxima) VALUES (1, 0, 10)")
+    conexion.commit()
+    maquinas._resurtir_producto(conexion, 1, 1, 5, 0)
+    conexion.commit()
+    yield conexion
+    conexion.close()
+
+
+def _planes(conexion: sqlite3.Connection, funcion, *args, **kwargs) -> dict:
+    """Ejecuta `funcion` y devuelve el plan de cada sentencia que envió a SQLite."""
+    sentencias = []
+    conexion.set_trace_callback(sentencias.append)
+    try:
+        funcion(conexion, *args, **kwargs)
+    except HTTPException:
+        pass
+    finally:
+        conexion.set_trace_callback(None)
+        conexion.rollback()
+    planes = {}
+    for sentencia in sentencias:
+        if sentencia.lstrip().upper().startswith(("SELECT", "UPDATE", "INSERT", "DELETE")):
+            planes[sentencia] = [fila[3] for fila in conexion.execute("EXPLAIN QUERY PLAN " + sentencia)]
+    assert planes, "la función no ejecutó ninguna consulta"
+    return planes
+
+
+def _sin_recorridos(planes: dict):
+    for sentencia, plan in planes.items():
+        assert not any(paso.startswith("SCAN") for paso in plan), (sentencia, plan)
+        assert not any("TEMP B-TREE" in paso for paso in plan), (sentencia, plan)
+        # Un INSERT ... VALUES no lee tablas y su plan queda vacío
+        assert not plan or any(paso.startswith("SEARCH") for paso in plan), (sentencia, plan)
+
+
+def test_consultas_por_maquina(maquinas, conexion):
+    _sin_recorridos(_planes(conexion, maquinas._obtener_informacion_maquina, 1, CATALOGO))
+    _sin_recorridos(_planes(conexion, maquinas._leer_productos, 1, CATALOGO))
+    _sin_recorridos(_planes(conexion, maquinas._resurtir_producto, 1, 1, 5, 0))
+    _sin_recorridos(_planes(conexion, maquinas._verficar_relleno_por_producto, 1, 1))
+
+
+@pytest.mark.parametrize("num_slot", [None, 0])
+def test_descuento_de_venta(maquinas, conexion, num_slot):
+    venta = maquinas.Venta(id_maquina=1, num_serie=1, num_slot=num_slot)
+    planes = _planes(conexion, maquinas._realizar_venta, venta, CATALOGO[1])
+    descuento = [plan for sentencia, plan in planes.items() if sentencia.startswith("UPDATE inventario")]
+    assert descuento
+    _sin_recorridos(planes)
+
+
+@pytest.mark.parametrize("tabla, columna_maquina", [("incidencias", "serie_maquina"),
+                                                    ("solicitudes_relleno", "num_serie_maquina")])
+@pytest.mark.parametrize("serie_maquina", [None, 1])
+def test_paginas_por_cursor(maquinas, conexion, tabla, columna_maquina, serie_maquina):
+    planes = _planes(conexion, maquinas._leer_pagina, 1000, 500, tabla=tabla,
+                     columna_maquina=columna_maquina, serie_maquina=serie_maquina)
+    _sin_recorridos(planes)
+    # La página arranca en el cursor en lugar de saltar las filas anteriores
+    assert all(any("rowid>?" in paso for paso in plan) for plan in planes.values()), planes
+
+
+@pytest.mark.parametrize("mes, dia", [(None, None), ("2024-01", None), (None, "2024-01-02")])
+def test_resumenes_por_maquina(maquinas, conexion, mes, dia):
+    _sin_recorridos(_planes(conexion, maquinas._obtener_ganancia_total_ventas, 1, mes, dia))
+
+
+@pytest.mark.parametrize("funcion", ["_ingreso_mensual_mas_alto", "_ingreso_mensual_mas_bajo"])
+def test_resumenes_de_la_flota(maquinas, conexion, funcion):
+    _sin_recorridos(_planes(conexion, getattr(maquinas, funcion), "2024-01"))
+    # Sin mes, el extremo sale del primer o último elemento del índice por total, sin ordenar la tabla
+    for plan in _planes(conexion, getattr(maquinas, funcion), None).values():
+        assert plan == ["SCAN ventas_por_maquina USING COVERING INDEX idx_ventas_por_maquina_total"], plan
+
+
+@pytest.mark.parametrize("agrupar", ["hora", "dia", "mes"])
+@pytest.mark.parametrize("serie_maquina, num_serie, indice", [(None, None, "idx_ventas_fecha"),
+                                                              (1, None, "idx_ventas_maquina_fecha"),
+                                                              (None, 1, "idx_ventas_producto_fecha"),
+                                                              (1, 1, "idx_ventas_maquina_producto_fecha")])
+def test_rango_de_ventas(maquinas, conexion, agrupar, serie_maquina, num_serie, indice):
+    planes = _planes(conexion, maquinas._ventas_por_rango, datetime(2024, 1, 1), datetime(2024, 1, 3),
+                     serie_maquina, num_serie, agrupar)
+    _sin_recorridos(planes)
+    assert all(any(indice + " " in paso for paso in plan) for plan in planes.values()), planes
+
+
+@pytest.mark.parametrize("porcentaje", [None, 50.0])
+def test_relleno_de_la_flota(maquinas, conexion, porcentaje):
+    _sin_recorridos(_planes(conexion, maquinas._verificar_relleno_flota, 10, porcentaje))
+
+
+@pytest.mark.parametrize("tabla", ["ventas", "resurtidos", "incidencias"])
+@pytest.mark.parametrize("serie_maquina", [None, 1])
+@pytest.mark.parametrize("desde, hasta", [(None, None), ("2024-01-01", "2024-02-01")])
+def test_paginas_de_exportacion(maquinas, conexion, tabla, serie_maquina, desde, hasta):
+    columna_maquina, columnas = maquinas.TABLAS_EXPORTABLES[tabla]
+    planes = _planes(conexion, maquinas._leer_pagina, None, maquinas.TAMANO_PAGINA_EXPORTACION, tabla=tabla,
+                     columna_maquina=columna_maquina, serie_maquina=serie_maquina, desde=desde, hasta=hasta,
+                     columnas=", ".join(columnas))
+    _sin_recorridos(planes)
+
+
+def test_lotes(maquinas, conexion):
+    ventas = [maquinas.Venta(id_maquina=serial, num_serie=1) for serial in (1, 1, 2)]
+    _sin_recorridos(_planes(conexion, maquinas._realizar_ventas_lote, ventas, CATALOGO))
+    altas = [maquinas.AltaMaquina(serial=serial, ubicacion="Pruebas", direccion="", num_slots=2) for serial in (1, 7, 8)]
+    _sin_recorridos(_planes(conexion, maquinas._crear_maquinas_lote, altas))
+
+
+@pytest.mark.parametrize("agrupar", ["hora", "dia", "mes"])
+def test_rango_de_ventas_coincide_con_agrupar_en_sql(maquinas, conexion, monkeypatch, agrupar):
+    # Una zona con horario de verano: los periodos locales de Python deben coincidir con los de SQLite
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        aleatorio = random.Random(7)
+        inicio = int(datetime(2023, 2, 20).timestamp())
+        conexion.executemany("INSERT INTO ventas (serie_maquina, num_serie, nombre_producto, monto, cantidad, fecha) "
+                             "VALUES (?, ?, 'Soles', ?, ?, ?)",
+                             [(aleatorio.choice((1, 2)), aleatorio.choice((1, 2)), 15.5, aleatorio.randint(1, 3),
+                               inicio + aleatorio.randrange(300 * 24 * 3600)) for _ in range(3000)])
+        conexion.commit()
+        desde, hasta = datetime(2023, 3, 10, 17, 30), datetime(2023, 11, 6, 6)
+        obtenido = maquinas._ventas_por_rango(conexion, desde, hasta, 1, None, agrupar)["periodos"]
+        esperado = conexion.execute(
+            "SELECT strftime(?, fecha, 'unixepoch', 'localtime') AS periodo, SUM(monto), SUM(cantidad), COUNT(*) "
+            "FROM ventas WHERE fecha >= ? AND fecha < ? AND serie_maquina = 1 GROUP BY periodo ORDER BY periodo",
+            (maquinas.FORMATOS_AGRUPACION[agrupar], int(desde.timestamp()), int(hasta.timestamp()))).fetchall()
+        assert [tuple(periodo.values()) for periodo in obtenido] == esperado
+    finally:
+        monkeypatch.undo()
+        time.tzset()
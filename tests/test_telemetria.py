@@ -0,0 +1,42 @@
+import asyncio
+
+from conftest import en_bucle
+
+
+class WebSocketFalso:
+    """Entrega los mensajes dados y, al agotarse, un cierre o una espera indefinida."""
+
+    def __init__(self, textos, cerrar=True):
+        self.mensajes = [{"type": "websocket.receive", "text": texto} for texto in textos]
+        self.cerrar = cerrar
+
+    async def receive(self):
+        if self.mensajes:
+            return self.mensajes.pop(0)
+        if self.cerrar:
+            return {"type": "websocket.disconnect"}
+        await asyncio.Event().wait()
+
+
+def test_el_lector_no_se_bloquea_con_la_cola_llena(maquinas):
+    async def escenario():
+        # Nadie consume: el cierre debe encolarse igualmente
+        pendientes = asyncio.Queue(2)
+        await asyncio.wait_for(maquinas._recibir_telemetria(WebSocketFalso(["a", "b"]), pendientes), 1)
+        cerrada = [pendientes.get_nowait() for _ in range(pendientes.qsize())]
+
+        pendientes = asyncio.Queue(2)
+        lector = asyncio.create_task(maquinas._recibir_telemetria(WebSocketFalso(["a", "b"], cerrar=False), pendientes))
+        await asyncio.sleep(0.01)
+        lector.cancel()
+        await asyncio.wait([lector], timeout=1)
+        return cerrada, lector.done(), [pendientes.get_nowait() for _ in range(pendientes.qsize())]
+
+    assert asyncio.run(escenario()) == (["b", None], True, ["b", None])
+
+
+def test_el_acuse_de_un_evento_invalido_solo_nombra_los_campos(maquinas):
+    lote = ['{"id": 1, "tipo": "venta", "cantidad": 0, "num_serie": "x"}', "no es json"]
+    resultados = en_bucle(maquinas.db, maquinas._aplicar_telemetria(maquinas.db, 1, lote))
+    assert resultados == [{"id": None, "codigo": 422, "detalle": "Evento inválido", "campos": ["cantidad", "num_serie"]},
+                          {"id": None, "codigo": 422, "detalle": "Evento inválido", "campos": []}]
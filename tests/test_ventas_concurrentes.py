@@ -0,0 +1,75 @@
+import asyncio
+import random
+
+import pytest
+
+from conftest import cliente, en_bucle, preparar_maquina
+
+
+def _existencias_y_vendido(maquinas, serial: int):
+    def leer(conexion):
+        existencias = conexion.execute("SELECT MIN(cantidad), SUM(cantidad) FROM inventario WHERE serie_maquina=?",
+                                       (serial,)).fetchone()
+        vendido = conexion.execute("SELECT COALESCE(SUM(cantidad), 0) FROM ventas WHERE serie_maquina=?",
+                                   (serial,)).fetchone()[0]
+        return existencias, vendido
+    return en_bucle(maquinas.db, maquinas.db.para_maquina(serial).ejecutar(leer))
+
+
+def test_ventas_simultaneas_no_dejan_existencias_negativas(maquinas):
+    serial, existencias = 3001, 50
+    aleatorio = random.Random(3001)
+    cantidades = [aleatorio.choice((1, 1, 2, 3)) for _ in range(200)]
+
+    async def escenario():
+        async with cliente(maquinas) as c:
+            await preparar_maquina(c, serial, existencias=existencias)
+
+            async def vender(cantidad):
+                respuesta = await c.post("/venta/", json={"id_maquina": serial, "num_serie": 1, "cantidad": cantidad})
+                assert respuesta.status_code in (200, 404), respuesta.text
+                return cantidad if respuesta.status_code == 200 else 0
+
+            return await asyncio.gather(*(vender(cantidad) for cantidad in cantidades))
+
+    vendidas = en_bucle(maquinas.db, escenario())
+    (minimo, restantes), registrado = _existencias_y_vendido(maquinas, serial)
+    # Ninguna unidad se vende dos veces: lo vendido y lo que queda suman lo resurtido
+    assert minimo >= 0
+    assert sum(vendidas) == registrado == existencias - restantes
+    assert restantes < max(cantidades)
+
+
+@pytest.mark.parametrize("cantidad", [0, -100])
+def test_venta_con_cantidad_no_positiva_se_rechaza(maquinas, cantidad):
+    serial = 3002 if cantidad == 0 else 3003
+
+    async def escenario():
+        async with cliente(maquinas) as c:
+            await preparar_maquina(c, serial, existencias=5)
+            return await c.post("/venta/", json={"id_maquina": serial, "num_serie": 1, "cantidad": cantidad})
+
+    assert en_bucle(maquinas.db, escenario()).status_code == 422
+    (_, restantes), registrado = _existencias_y_vendido(maquinas, serial)
+    assert (restantes, registrado) == (5, 0)
+
+
+def test_lote_con_cantidad_no_positiva_no_descuenta(maquinas):
+    serial = 3004
+
+    async def escenario():
+        async with cliente(maquinas) as c:
+            await preparar_maquina(c, serial, existencias=5)
+            respuesta = await c.post("/ventas/batch", json=[{"id_maquina": serial, "num_serie": 1, "cantidad": 1},
+                                                            {"id_maquina": serial, "num_serie": 1, "cantidad": -3}])
+            assert respuesta.status_code == 422
+            # Aunque el lote llegue sin validar, la función rechaza la fila en lugar de sumar existencias
+            ventas = [maquinas.Venta.model_construct(id_maquina=serial, num_serie=1, cantidad=cantidad, num_slot=None)
+                      for cantidad in (1, -3)]
+            return await maquinas.db.para_maquina(serial).ejecutar(maquinas._realizar_ventas_lote, ventas,
+                                                                   {1: ("Soles", 15.5)})
+
+    resultado = en_bucle(maquinas.db, escenario())
+    assert [fila["estado"] for fila in resultado["resultados"]] == [200, 422]
+    (_, restantes), registrado = _existencias_y_vendido(maquinas, serial)
+    assert (restantes, registrado) == (4, 1)